@@ -178,6 +178,8 @@ export class ApiService {
         requestUrl += `&pageSize=${pageSize}`;
       }
     }
+    // The detail page renders the complete highlighted document
+    requestUrl += (sortBy ? '&' : '?') + 'fullContent=true';
 
     let formData = new FormData();
     formData.append('query', `{!term f=${field}}${term}`);
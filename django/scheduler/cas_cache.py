@@ -0,0 +1,111 @@
+"""
+Process wide LRU cache of the parsed CAS files of the cas-files bucket.
+
+Entries are keyed on the object name and ETag, a stat_object call tells whether the cached CAS is still current.
+The cache is bounded on the decompressed XMI size of the entries, a parsed CAS takes a multiple of that in memory.
+A cached CAS is shared between its callers and must not be modified: callers that add annotations ask for a
+mutable CAS and get a deep copy when the CAS is shared, or the parsed CAS itself on a miss.
+"""
+import copy
+import gzip
+import logging
+import os
+import threading
+from collections import Counter, OrderedDict
+
+from cassis import load_cas_from_xmi
+
+from searchapp.stats import log_stats_periodically
+
+logger = logging.getLogger(__name__)
+
+CAS_BUCKET = "cas-files"
+CAS_CACHE_MAX_BYTES = int(os.environ.get("CAS_CACHE_MAX_BYTES", 256 * 1000 * 1000))
+
+
+class CasCache:
+    def __init__(self, max_bytes=CAS_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # object name -> (etag, typesystem, cas, size)
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def get(self, minio_client, object_name, typesystem, mutable=False, max_size=None):
+        """
+        Parsed CAS of object_name in the cas-files bucket, raises NoSuchKey when it doesn't exist.
+        Returns None when the compressed file is larger than max_size.
+        """
+        log_stats_periodically("CAS cache", self.stats)
+        object_info = minio_client.stat_object(CAS_BUCKET, object_name)
+        if max_size is not None and object_info.size > max_size:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(object_name)
+            if entry and entry[0] == object_info.etag and entry[1] is typesystem:
+                self._entries.move_to_end(object_name)
+                self._stats["hits"] += 1
+                cas = entry[2]
+            else:
+                self._stats["misses"] += 1
+                cas = None
+
+        if cas is not None:
+            if mutable:
+                # the typesystem is shared, only the feature structures are copied
+                return copy.deepcopy(cas, {id(typesystem): typesystem})
+            return cas
+
+        cas_gz = minio_client.get_object(CAS_BUCKET, object_name)
+        try:
+            with gzip.open(cas_gz, "rb") as f:
+                cas = load_cas_from_xmi(f, typesystem=typesystem, trusted=True)
+                size = f.tell()
+        finally:
+            cas_gz.close()
+            cas_gz.release_conn()
+
+        # a CAS that is going to be modified is not cached, the next caller would see the changes
+        if not mutable:
+            self._put(object_name, (object_info.etag, typesystem, cas, size))
+        return cas
+
+    def _put(self, object_name, entry):
+        size = entry[3]
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(object_name, None)
+            if previous:
+                self._size -= previous[3]
+            self._entries[object_name] = entry
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted[3]
+                self._stats["evictions"] += 1
+
+    def invalidate(self, object_name):
+        with self._lock:
+            entry = self._entries.pop(object_name, None)
+            if entry:
+                self._size -= entry[3]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self._stats["hits"],
+                "misses": self._stats["misses"],
+                "evictions": self._stats["evictions"],
+                "entries": len(self._entries),
+                "bytes": self._size,
+            }
+
+
+cas_cache = CasCache()
+
+
+def get_cas(minio_client, document_id, typesystem, mutable=False, max_size=None):
+    """Parsed CAS of a document from the cas-files bucket, through the process wide cache."""
+    return cas_cache.get(minio_client, str(document_id) + ".xml.gz", typesystem, mutable=mutable, max_size=max_size)
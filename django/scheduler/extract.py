@@ -4,11 +4,13 @@ import json
 import logging
 import os
 import urllib
-import pysolr
 import cassis
 import requests
 import math
 import gzip
+import hashlib
+import threading
+from io import BytesIO
 
 from cassis import (
     Cas,
@@ -19,14 +21,18 @@ from cassis import (
 )
 from cassis.typesystem import load_typesystem, FeatureStructure
 from celery import shared_task, chain
+from celery.signals import worker_init
 from glossary.models import Concept, ConceptOccurs, ConceptDefined, AcceptanceState, Lemma
 from searchapp.models import Website, Document
+from searchapp.solr_call import solr_iterate
 from obligations.models import ReportingObligation, ReportingObligationOffsets
 from minio import Minio, ResponseError
 from minio.error import BucketAlreadyOwnedByYou, BucketAlreadyExists, NoSuchKey
 from pycaprio.mappings import InceptionFormat, DocumentState
 from pycaprio import Pycaprio
 
+from scheduler.cas_cache import cas_cache, get_cas
+
 from glossary.models import AnnotationWorklog
 
 logger = logging.getLogger(__name__)
@@ -156,28 +162,90 @@ def save_to_rdf(cas, doc_id, source_name, source_url):
 
 
 def create_cas(sofa):
-    with open(DEFAULT_TYPESYSTEM, "rb") as f:
-        ts = load_typesystem(f)
-
-    cas = Cas(typesystem=ts)
+    cas = Cas(typesystem=fetch_typesystem())
     cas.sofa_string = sofa
     return cas
 
 
+def download_typesystem(file_path):
+    """Fetch the typesystem from UIMA, written to a temporary file first so no process reads a partial file."""
+    typesystem_req = requests.get(UIMA_URL["BASE"] + UIMA_URL["TYPESYSTEM"])
+    typesystem_req.raise_for_status()
+    tmp_path = "{}.{}.tmp".format(file_path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(typesystem_req.content)
+    os.replace(tmp_path, file_path)
+
+
+class TypesystemCache:
+    """
+    Parsed typesystem, loaded once per process.
+    The file is checked with a stat() on every call and only parsed again when its mtime or size changed and its
+    content (the version that was served by UIMA when the file was downloaded) is different. The typesystem merged
+    with the FISMA types is built on first use. The typesystems are shared, they must not be modified.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self._stat = None
+        self._digest = None
+        self._typesystem = None
+        self._typesystem_fisma = None
+
+    def get(self):
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            with self._lock:
+                if not os.path.exists(self.file_path):
+                    logger.info("Fetching typesystem from %s", UIMA_URL["BASE"] + UIMA_URL["TYPESYSTEM"])
+                    download_typesystem(self.file_path)
+            stat = os.stat(self.file_path)
+
+        key = (stat.st_mtime_ns, stat.st_size)
+        if key == self._stat:
+            return self._typesystem
+        with self._lock:
+            if key != self._stat:
+                with open(self.file_path, "rb") as f:
+                    content = f.read()
+                digest = hashlib.sha1(content).hexdigest()
+                if digest != self._digest:
+                    logger.info("Loading typesystem %s (%s)", self.file_path, digest)
+                    self._typesystem = load_typesystem(BytesIO(content))
+                    self._typesystem_fisma = None
+                    self._digest = digest
+                self._stat = key
+            return self._typesystem
+
+    def get_fisma(self):
+        typesystem = self.get()
+        with self._lock:
+            if self._typesystem_fisma is None or self._typesystem_fisma[0] is not typesystem:
+                self._typesystem_fisma = (typesystem, merge_typesystems(typesystem, generate_typesystem_fisma()))
+            return self._typesystem_fisma[1]
+
+
+_typesystem_cache = TypesystemCache(DEFAULT_TYPESYSTEM)
+
+
 def fetch_typesystem():
-    try:
-        # Check if file exits
-        f = open(DEFAULT_TYPESYSTEM)
-        f.close()
-    except IOError:
-        # Fetch from UIMA
-        typesystem_req = requests.get(UIMA_URL["BASE"] + UIMA_URL["TYPESYSTEM"])
-        typesystem_file = open(DEFAULT_TYPESYSTEM, "w")
-        typesystem_file.write(typesystem_req.content.decode("utf-8"))
+    return _typesystem_cache.get()
+
 
-    # FIXME: load only once ?
-    with open(DEFAULT_TYPESYSTEM, "rb") as f:
-        return load_typesystem(f)
+def fetch_typesystem_fisma():
+    """Typesystem merged with the FISMA term and definition types."""
+    return _typesystem_cache.get_fisma()
+
+
+@worker_init.connect
+def preload_typesystem(**kwargs):
+    # loaded in the main worker process, the pool processes inherit it
+    try:
+        fetch_typesystem()
+    except (OSError, requests.RequestException) as err:
+        logger.warning("Failed to preload typesystem: %s", err)
 
 
 def get_cas_from_pdf(content, docid):
@@ -345,9 +413,6 @@ def extract_reporting_obligations(website_id, document_id=None):
     website = Website.objects.get(pk=website_id)
     website_name = website.name.lower()
     core = "documents"
-    page_number = 0
-    rows_per_page = 250
-    cursor_mark = "*"
 
     if document_id:
         q = "id:" + document_id
@@ -357,15 +422,7 @@ def extract_reporting_obligations(website_id, document_id=None):
         q = QUERY_WEBSITE + website_name + " AND acceptance_state:accepted"
 
     # Load all documents from Solr
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    options = {
-        "rows": rows_per_page,
-        "start": page_number,
-        "cursorMark": cursor_mark,
-        "sort": QUERY_ID_ASC,
-        "fl": "content_html,content,id",
-    }
-    documents = client.search(q, **options)
+    documents = solr_iterate(core, q, fl="content_html,content,id")
 
     # Divide the document in chunks
     extract_reporting_obligations_for_document.chunks(zip(documents), int(CELERY_EXTRACT_TERMS_CHUNKS)).delay()
@@ -576,9 +633,6 @@ def extract_terms(website_id, document_id=None):
     website = Website.objects.get(pk=website_id)
     website_name = website.name.lower()
     core = "documents"
-    page_number = 0
-    rows_per_page = 250
-    cursor_mark = "*"
 
     if document_id:
         q = "id:" + document_id
@@ -588,15 +642,7 @@ def extract_terms(website_id, document_id=None):
         q = QUERY_WEBSITE + website_name + " AND acceptance_state:accepted"
 
     # Load all documents from Solr
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    options = {
-        "rows": rows_per_page,
-        "start": page_number,
-        "cursorMark": cursor_mark,
-        "sort": QUERY_ID_ASC,
-        "fl": "content_html,content,id",
-    }
-    documents = client.search(q, **options)
+    documents = solr_iterate(core, q, fl="content_html,content,id")
 
     # Divide the document in chunks
     extract_terms_for_document.chunks(zip(documents), int(CELERY_EXTRACT_TERMS_CHUNKS)).delay()
@@ -647,11 +693,7 @@ def extract_terms_for_document(document, debug_cas=True):
         if debug_cas:
             raise NoSuchKey
 
-        cas_gz = minio_client.get_object(
-            "cas-files",
-            str(django_doc.id) + ".xml.gz",
-        )
-        cas = load_compressed_cas(cas_gz, typesystem)
+        cas = get_cas(minio_client, django_doc.id, typesystem)
         paragraph_request = {}
         paragraph_request["cas_content"] = base64.b64encode(bytes(cas.to_xmi(), "utf-8")).decode()
         paragraph_request["content_type"] = "html"
@@ -1064,16 +1106,15 @@ def send_document_to_webanno(document_id):
         secret_key=os.environ["MINIO_SECRET_KEY"],
         secure=False,
     )
+    # Load typesystems
+    merged_ts = fetch_typesystem_fisma()
+
     try:
-        cas_gz = minio_client.get_object("cas-files", document_id + ".xml.gz")
+        # the views are modified below
+        cas = get_cas(minio_client, document_id, merged_ts, mutable=True)
     except NoSuchKey:
         return None
 
-    # Load typesystems
-    merged_ts = merge_typesystems(fetch_typesystem(), generate_typesystem_fisma())
-
-    cas = load_compressed_cas(cas_gz, merged_ts)
-
     # # Clean up annotations for Webanno
     SOFA_ID_HTML2TEXT = "html2textView"
     # Modify cas to make html2textview the _InitialView
@@ -1130,12 +1171,7 @@ def export_all_user_data(website_id, document_id=None):
         logger.info("Extracting document: %s", str(document.id))
 
         try:
-            cas_gz = minio_client.get_object(
-                "cas-files",
-                str(document.id) + ".xml.gz",
-            )
-
-            cas = load_compressed_cas(cas_gz, typesystem)
+            cas = get_cas(minio_client, document.id, typesystem, mutable=True)
             logger.info("Loaded cas from Minio")
 
             annotations = AnnotationWorklog.objects.filter(document=document)
@@ -1198,9 +1234,12 @@ def export_all_user_data(website_id, document_id=None):
             logger.info("Saved gzipped cas: %s", file.name)
 
             minio_client.fput_object("cas-files", filename, file.name)
+            cas_cache.invalidate(filename)
             logger.info("Uploaded to minio")
 
             os.remove(file.filename)
 
         except NoSuchKey:
             pass
+
+    logger.info("CAS cache: %s", cas_cache.stats())
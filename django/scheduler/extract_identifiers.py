@@ -1,19 +1,16 @@
 import re
-from collections import Counter
 
-url_pattern = "(((?!.*\/)[a-z0-9-_]+?)+)"
-date_pattern = "([0-9]{1,2}\s[A-Za-z]+\s[0-9]{4})"
+url_pattern = re.compile("(((?!.*\/)[a-z0-9-_]+?)+)")
+date_pattern = re.compile("([0-9]{1,2}\s[A-Za-z]+\s[0-9]{4})")
 patterns = {
     "fsb": date_pattern,
     "bis": date_pattern,
     "srb": date_pattern,
-    "esma": "(ESMA[A-Za-z0-9/-]+)",
-    "eba": "(EBA[A-Za-z0-9/-]+)",
-    "eiopa": "EIOPA[A-Za-z0-9/-]+",
+    "esma": re.compile("(ESMA[A-Za-z0-9/-]+)"),
+    "eba": re.compile("(EBA[A-Za-z0-9/-]+)"),
+    "eiopa": re.compile("EIOPA[A-Za-z0-9/-]+"),
 }
 
-CNT = Counter()
-
 
 def get_source(url):
     source = ""
@@ -23,32 +20,42 @@ def get_source(url):
     return source
 
 
-def retrieve_identifier(doc):
-    url = doc["url"][0]
+def clean_identifier(identifier):
+    return identifier.replace(" ", "_").replace("\n", "_").replace(u"\xa0", "_")
+
+
+def retrieve_identifier(url, content):
+    """
+    Identifier of a document without the duplicate suffix, an empty string if none can be found.
+    Documents with the same identifier are numbered afterwards, see update_documents_custom_id_task.
+    """
     source = get_source(url)
-    content = doc["content"][0]
     if source not in patterns:
         return ""
-    pattern = patterns[source]
-    m = re.findall(pattern, content[:250])
+    m = patterns[source].findall(content[:250])
     if len(m) == 0:
-        m = re.findall(date_pattern, content)
+        m = date_pattern.findall(content)
         if len(m) == 0:
-            if url[-1] is "/":
+            if url[-1] == "/":
                 url = url[:-1]
-            m = re.findall(url_pattern, url.split("/")[-1].rsplit(".", 1)[0])[0]
-        identifier = source.upper() + "_" + m[0].replace(" ", "_").replace("\n", "_").replace(u"\xa0", "_")
-    else:
-        m = m[0]
-        if source in ["fsb", "bis", "srb"]:
-            identifier = source.upper() + "_" + m.replace(" ", "_").replace("\n", "_").replace(u"\xa0", "_")
-        else:
-            identifier = m
-            if not any(x.isdigit() for x in m):
-                m = re.findall(date_pattern, content)[0]
-                identifier = source.upper() + "_" + m.replace(" ", "_").replace("\n", "_").replace(u"\xa0", "_")
-
-    CNT[identifier] += 1
-    if CNT[identifier] != 1:
-        identifier = identifier + "_" + str(CNT[identifier])
-    return identifier
+            m = url_pattern.findall(url.split("/")[-1].rsplit(".", 1)[0])
+            if len(m) == 0:
+                return ""
+            m = m[0]
+        return source.upper() + "_" + clean_identifier(m[0])
+
+    m = m[0]
+    if source in ["fsb", "bis", "srb"]:
+        return source.upper() + "_" + clean_identifier(m)
+    if not any(x.isdigit() for x in m):
+        m = date_pattern.findall(content)
+        if len(m) == 0:
+            return ""
+        return source.upper() + "_" + clean_identifier(m[0])
+    return m
+
+
+def retrieve_identifier_of_doc(doc):
+    """Process pool entry point, doc is an (id, url, content) tuple."""
+    doc_id, url, content = doc
+    return doc_id, retrieve_identifier(url, content)
@@ -0,0 +1,94 @@
+"""
+Streaming upload of objects of unknown size to MinIO.
+
+The minio client only streams objects of which the length is known up front. MultipartWriter is a write only file
+object that buffers part_size bytes and uploads every full part as a part of a multipart upload, the object is
+never held in full in memory or on disk. Objects smaller than one part are uploaded with a single put_object.
+
+minio 6.0.0 has no public streaming upload (put_object needs the length), the writer uses its private multipart
+methods. minio is pinned in requirements.txt, scheduler.tests checks that these methods still exist.
+"""
+import logging
+from io import BytesIO
+
+from minio.definitions import UploadPart
+
+logger = logging.getLogger(__name__)
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class MultipartWriter:
+    def __init__(
+        self, minio_client, bucket_name, object_name, content_type="application/octet-stream", part_size=MIN_PART_SIZE
+    ):
+        self.client = minio_client
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.content_type = content_type
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.upload_id = None
+        self.parts = {}
+        self.size = 0
+        self._buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[: self.part_size]))
+            del self._buffer[: self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.client._new_multipart_upload(
+                self.bucket_name, self.object_name, {"Content-Type": self.content_type}
+            )
+        part_number = len(self.parts) + 1
+        etag, _ = self.client._do_put_object(
+            self.bucket_name, self.object_name, data, len(data), upload_id=self.upload_id, part_number=part_number
+        )
+        self.parts[part_number] = UploadPart(
+            self.bucket_name, self.object_name, self.upload_id, part_number, etag, None, len(data)
+        )
+
+    def close(self):
+        """Upload the last part and complete the upload."""
+        data = bytes(self._buffer)
+        self._buffer = bytearray()
+        if self.upload_id is None:
+            self.client.put_object(
+                self.bucket_name, self.object_name, BytesIO(data), len(data), content_type=self.content_type
+            )
+            return
+        try:
+            if data:
+                self._upload_part(data)
+            self.client._complete_multipart_upload(self.bucket_name, self.object_name, self.upload_id, self.parts)
+        except Exception:
+            self.abort()
+            raise
+
+    def abort(self):
+        """Remove the parts that were uploaded, nothing is stored under the object name."""
+        self._buffer = bytearray()
+        if self.upload_id is None:
+            return
+        try:
+            self.client._remove_incomplete_upload(self.bucket_name, self.object_name, self.upload_id)
+        except Exception as err:
+            logger.warning("Failed to abort upload of %s/%s: %s", self.bucket_name, self.object_name, err)
+        self.upload_id = None
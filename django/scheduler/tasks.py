@@ -3,26 +3,37 @@ from __future__ import absolute_import, unicode_literals
 import json
 import logging
 import os
-import shutil
 import csv
+import tempfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime, timedelta
-from io import BytesIO
-from pathlib import Path
 
-import pysolr
+from billiard.pool import Pool
 from celery import shared_task, chain
-from django.core.exceptions import ValidationError
 from django.db.models.functions import Length
 from jsonlines import jsonlines
+from django.db import DatabaseError, connection
 from django.db.models import Q
+from django.utils import timezone
 from langdetect import detect_langs
 from langdetect.lang_detect_exception import LangDetectException
 from minio import Minio, ResponseError
 from minio.error import NoSuchKey
 from minio.error import BucketAlreadyOwnedByYou, BucketAlreadyExists
+from minio.select import (
+    CSVOutput,
+    InputSerialization,
+    JSONInput,
+    OutputSerialization,
+    RequestProgress,
+    SelectMessageError,
+    SelectObjectOptions,
+)
+import requests
 from scrapy.crawler import CrawlerRunner
 from scrapy.utils.project import get_project_settings
-from tika import parser
 from twisted.internet import reactor
 
 from scheduler.extract import (
@@ -30,10 +41,30 @@ from scheduler.extract import (
     extract_reporting_obligations,
     export_all_user_data,
 )
-from scheduler.extract_identifiers import retrieve_identifier
-from searchapp.datahandling import score_documents
-from searchapp.models import Website, Document, AcceptanceState, Tag, AcceptanceStateValue
-from searchapp.solr_call import solr_search_website_sorted, solr_search_website_with_content
+from scheduler.extract_identifiers import retrieve_identifier_of_doc
+from scheduler.minio_upload import MultipartWriter
+from searchapp.datahandling import score_documents, update_documents_unvalidated
+from searchapp.bulk import BULK_BATCH_SIZE, bulk_upsert, iter_batches
+from searchapp.minhash import update_document_signature
+from searchapp.pdf_text import PDF_MAX_SIZE_BYTES, PDF_SPOOL_MAX_MEMORY, TikaTimeout, parse_with_tika
+from searchapp.models import (
+    Website,
+    Document,
+    AcceptanceState,
+    Tag,
+    AcceptanceStateValue,
+    DocumentSignature,
+    ScrapedContentHash,
+)
+from searchapp.solr_call import (
+    solr_search_website_sorted,
+    solr_search_website_with_content,
+    solr_search_website_content_head,
+    solr_iterate,
+    get_id_filters,
+    get_solr_client,
+    SolrUpdateBuffer,
+)
 
 from scheduler.integration_tests import test_concept_highlights_it
 
@@ -44,12 +75,27 @@ from glossary.models import Tag as ConceptTag
 from obligations.models import ReportingObligation
 
 logger = logging.getLogger(__name__)
-workpath = os.path.dirname(os.path.abspath(__file__))
 
-CONST_EXPORT = "/export/"
 QUERY_ID_ASC = "id asc"
 QUERY_WEBSITE = "website:"
 
+# Number of documents that are parsed by Tika at the same time
+TIKA_MAX_WORKERS = int(os.environ.get("TIKA_MAX_WORKERS", 4))
+# Seconds a document can take to parse before it is skipped
+TIKA_PARSE_TIMEOUT = float(os.environ.get("TIKA_PARSE_TIMEOUT", 120))
+# Parses that take longer are logged
+TIKA_SLOW_SECONDS = float(os.environ.get("TIKA_SLOW_SECONDS", 30))
+# Number of scraped jsonlines files that are sent to Solr at the same time
+SCRAPY_SYNC_MAX_WORKERS = int(os.environ.get("SCRAPY_SYNC_MAX_WORKERS", 4))
+# Number of processes that extract the custom ids and the documents sent to a process at a time
+CUSTOM_ID_PROCESSES = int(os.environ.get("CUSTOM_ID_PROCESSES", 4))
+CUSTOM_ID_CHUNK_SIZE = int(os.environ.get("CUSTOM_ID_CHUNK_SIZE", 100))
+# Documents fetched from Solr per query and size of the parts of the uploaded export zip
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 500))
+EXPORT_PART_SIZE = int(os.environ.get("EXPORT_PART_SIZE", 16 * 1024 * 1024))
+EXPORT_PROGRESS = "PROGRESS"
+SCRAPED_CONTENT_HASH_FIELDS = ["website", "content_hash", "updated_at"]
+
 
 @shared_task
 def full_service_task(website_id, **kwargs):
@@ -64,6 +110,7 @@ def full_service_task(website_id, **kwargs):
         sync_scrapy_to_solr_task.si(website_id),
         parse_content_to_plaintext_task.si(website_id, date=kwargs.get("date", None)),
         sync_documents_task.si(website_id, date=kwargs.get("date", None)),
+        update_document_signatures_task.si(website_id),
         score_documents_task.si(website_id, date=kwargs.get("date", None)),
         check_documents_unvalidated_task.si(website_id),
         update_documents_custom_id_task.si(website_id),
@@ -96,7 +143,7 @@ def delete_deprecated_acceptance_states():
 def reset_pre_analyzed_fields_document(document_id):
     logger.info("Resetting all PreAnalyzed fields for DOCUMENT: %s", document_id)
     core = "documents"
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
+    client = get_solr_client(core)
     document = {"id": document_id, "concept_occurs": {"set": ""}, "concept_defined": {"set": ""}}
     client.add(document, commit=True)
 
@@ -107,112 +154,97 @@ def reset_pre_analyzed_fields(website_id):
     logger.info("Resetting all PreAnalyzed fields for WEBSITE: %s", website.name)
 
     website_name = website.name.lower()
-    page_number = 0
-    rows_per_page = 250
-    cursor_mark = "*"
     core = "documents"
     # select all records where content is empty and content_html is not
     q = "( concept_occurs: [* TO *] OR concept_defined: [* TO *] ) AND website:" + website_name
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    options = {"rows": rows_per_page, "start": page_number, "cursorMark": cursor_mark, "sort": QUERY_ID_ASC}
-    results = client.search(q, **options)
-    items = []
+    results = solr_iterate(core, q, fl="id")
 
-    for result in results:
-        # add to document model and save
-        document = {"id": result["id"], "concept_occurs": {"set": ""}, "concept_defined": {"set": ""}}
-        items.append(document)
-
-        if len(items) == 1000:
-            logger.info("Got 1000 items, posting to solr")
-            client.add(items, commit=True)
-            items = []
-
-    # Send to solr
-    client.add(items, commit=True)
+    with SolrUpdateBuffer(core, name="reset " + website_name) as solr_updates:
+        for result in results:
+            # add to document model and save
+            document = {"id": result["id"], "concept_occurs": {"set": ""}, "concept_defined": {"set": ""}}
+            solr_updates.add(document)
 
 
 @shared_task
-def export_documents():
+def export_documents(website_ids=None):
+    """
+    Zip file in the export bucket with a doc_<id>.jsonl file for every human validated document: the Solr document,
+    the state of the auto classifier and the human validations, one per line. The zip is written straight into a
+    multipart upload, the progress is reported as a PROGRESS task state.
+    """
     logger.info("Export all human validated documents...")
+    task_id = export_documents.request.id
     # Find all human validated documents:
     # - no probability model
     # - ACCEPTED or REJECTED
     # - group by document
-    human_states = AcceptanceState.objects.filter(
-        (Q(value=AcceptanceStateValue.ACCEPTED) | Q(value=AcceptanceStateValue.REJECTED)) & Q(probability_model=None)
-    ).order_by("document")
+    human_states = Q(value__in=[AcceptanceStateValue.ACCEPTED, AcceptanceStateValue.REJECTED], probability_model=None)
+    classifier_states = Q(probability_model="auto classifier")
+    human_documents = AcceptanceState.objects.filter(human_states)
+    if website_ids:
+        human_documents = human_documents.filter(document__website__in=website_ids)
+    states = (
+        AcceptanceState.objects.filter(
+            human_states | classifier_states, document__in=human_documents.values("document")
+        )
+        .order_by("document_id", "id")
+        .values_list(
+            "document_id",
+            "probability_model",
+            "value",
+            "user__username",
+            "accepted_probability",
+            "accepted_probability_index",
+        )
+    )
+    # document id -> the lines after the document
+    document_lines = {}
+    for document_id, probability_model, value, username, probability, probability_index in states:
+        lines = document_lines.setdefault(str(document_id), {"classifier": None, "human_validations": []})
+        if probability_model is None:
+            lines["human_validations"].append({"human_validation": value, "username": username})
+        elif lines["classifier"] is None:
+            lines["classifier"] = {
+                "classifier_status": value,
+                "classifier_score": probability,
+                "classifier_index": probability_index,
+            }
+    total = len(document_lines)
+    logger.info("Exporting %s documents", total)
 
-    core = "documents"
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    workdir = workpath + CONST_EXPORT + export_documents.request.id
-    os.makedirs(workdir)
-
-    # Find documents for all document ids found in human validated acceptance states
-    for human_state in human_states:
-        human_validation = {"human_validation": human_state.value, "username": human_state.user.username}
-        doc_id = human_state.document.id
-        q = "id:" + str(doc_id)
-        documents = client.search(q, **{})
-        for document in documents:
-            # Each .jsonl file contains min 3 lines: document, auto classifier, human validation
-            jsonl_file = Path(workdir + "/doc_" + document["id"] + ".jsonl")
-            if jsonl_file.is_file():
-                # if the file for a document id already exists, append human validation
-                with jsonl_file.open(mode="a") as f:
-                    f.write(json.dumps(human_validation))
-                    f.write("\n")
-            else:
-                # file for document id doesn't exist, write document, auto classifier and human validation
-                with jsonl_file.open(mode="w") as f:
-                    # DOCUMENT
-                    f.write(json.dumps(document))
-                    f.write("\n")
-
-                    # Get acceptance state AUTO CLASSIFIER from django model
-                    acceptance_state_qs = AcceptanceState.objects.filter(
-                        document__id=document["id"], probability_model="auto classifier"
-                    )
-                    if acceptance_state_qs:
-                        acceptance_state = acceptance_state_qs[0]
-                        classifier_score = acceptance_state.accepted_probability
-                        classifier_status = acceptance_state.value
-                        classifier_index = acceptance_state.accepted_probability_index
-                        classifier = {
-                            "classifier_status": classifier_status,
-                            "classifier_score": classifier_score,
-                            "classifier_index": classifier_index,
-                        }
-                        f.write(json.dumps(classifier))
-                        f.write("\n")
-
-                    # HUMAN validation
-                    f.write(json.dumps(human_validation))
-
-    # create zip file for all .jsonl files
-    zip_destination = workpath + CONST_EXPORT + export_documents.request.id
-    shutil.make_archive(zip_destination, "zip", workpath + CONST_EXPORT + export_documents.request.id)
-
-    # upload zip to minio
     minio_client = Minio(
         os.environ["MINIO_STORAGE_ENDPOINT"],
         access_key=os.environ["MINIO_ACCESS_KEY"],
         secret_key=os.environ["MINIO_SECRET_KEY"],
         secure=False,
     )
-    try:
-        minio_client.make_bucket("export")
-    except BucketAlreadyOwnedByYou as err:
-        pass
-    except BucketAlreadyExists as err:
-        pass
-    except ResponseError as err:
-        raise
-    minio_client.fput_object("export", export_documents.request.id + ".zip", zip_destination + ".zip")
-
-    shutil.rmtree(workpath + CONST_EXPORT + export_documents.request.id)
-    os.remove(zip_destination + ".zip")
-    logging.info("Removed: %s", zip_destination + ".zip")
+    create_bucket(minio_client, "export")
+
+    done = 0
+    exported = 0
+    with MultipartWriter(
+        minio_client, "export", task_id + ".zip", content_type="application/zip", part_size=EXPORT_PART_SIZE
+    ) as upload:
+        with zipfile.ZipFile(upload, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for id_filter in get_id_filters(document_lines.keys(), EXPORT_BATCH_SIZE):
+                # Each .jsonl file contains min 3 lines: document, auto classifier, human validation
+                for document in solr_iterate("documents", "*:*", fq=id_filter):
+                    lines = document_lines[document["id"]]
+                    jsonl = [document]
+                    if lines["classifier"]:
+                        jsonl.append(lines["classifier"])
+                    jsonl.extend(lines["human_validations"])
+                    archive.writestr(
+                        "doc_" + document["id"] + ".jsonl", "".join(json.dumps(line) + "\n" for line in jsonl)
+                    )
+                    exported += 1
+                done = min(done + EXPORT_BATCH_SIZE, total)
+                export_documents.update_state(
+                    state=EXPORT_PROGRESS,
+                    meta={"current": done, "total": total, "percent": round(100 * done / total)},
+                )
+    logger.info("Exported %s documents in %s bytes to export/%s.zip", exported, upload.size, task_id)
 
 
 def chunks(lst, n):
@@ -223,6 +255,11 @@ def chunks(lst, n):
 
 @shared_task
 def handle_document_updates_task(website_id):
+    """
+    Copy the documents of which the scraped content changed to the archive core, before sync_scrapy_to_solr_task
+    overwrites them. Only the pending jsonlines files of the website are read, their content hashes are compared
+    with the scraped content hashes per batch.
+    """
     website = Website.objects.get(pk=website_id)
     logger.info("Handle updates for WEBSITE: %s", str(website))
     # process files from minio
@@ -233,72 +270,98 @@ def handle_document_updates_task(website_id):
         secure=False,
     )
     bucket_name = website.name.lower()
-    # get all content_hashes
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + "documents")
-    client_archive = pysolr.Solr(os.environ["SOLR_URL"] + "/" + "archive")
-    options = {"rows": 250000, "fl": "id,content_hash"}
-    results = client.search("*:*", **options)
-    content_hashes = {}
-    for result in results:
-        if "content_hash" in result:
-            content_hashes[result["id"]] = result["content_hash"]
-    logger.info("Found " + str(len(content_hashes)) + " hashes")
 
-    try:
-        # retrieve jsonlines files from minio
-        objects = minio_client.list_objects(bucket_name)
-        archive_items = []
-        for obj in objects:
+    archived = 0
+    with SolrUpdateBuffer("archive", name="archive " + bucket_name) as archive_updates:
+        for obj in minio_client.list_objects(bucket_name):
             logger.info("Working on %s", obj.object_name)
             file_data = minio_client.get_object(bucket_name, obj.object_name)
-            with jsonlines.Reader(BytesIO(file_data.data)) as reader:
-                for obj in reader:
-                    # check if updated (see if we can find the hash from the jsonl object in the list of known content_hashes)
-                    if obj["id"] in content_hashes and obj["content_hash"] != content_hashes[obj["id"]]:
-                        archive_items.append(obj["id"])
-
-            logger.info("Going to archive " + str(len(archive_items)) + " items")
-            # archive_items is the list of all solr document ids that need to be copied to the archive
-            for chunk in chunks(archive_items, 100):
-                solr_ids = ("AND id: ").join(chunk)
-                options = {"rows": 100}
-                results = client.search("id:" + solr_ids, **options)
-                # update ids in results
-                updates = []
-                for result in results:
-                    result["document_id"] = result["id"]
-                    result["id"] = result["id"] + result["content_hash"]
-                    del result["_version_"]
-                    updates.append(result)
-                # send results to archive
-                client_archive.add(updates, commit=True)
-                updates = []
-
-    except ResponseError as err:
-        raise
+            try:
+                with jsonlines.Reader(file_data) as reader:
+                    for batch in iter_batches(reader, BULK_BATCH_SIZE):
+                        content_hashes = get_scraped_content_hashes([json["id"] for json in batch], website)
+                        # updated documents: known id and content hash, other content hash
+                        archive_items = [
+                            json["id"]
+                            for json in batch
+                            if content_hashes.get(json["id"])
+                            and json.get("content_hash") != content_hashes[json["id"]]
+                        ]
+                        archived += archive_documents(archive_items, archive_updates)
+            finally:
+                file_data.close()
+                file_data.release_conn()
+    logger.info("Archived %s updated documents of %s", archived, bucket_name)
+
+
+def archive_documents(ids, archive_updates):
+    """Add the current version of the documents to the archive core, under their id and content hash."""
+    count = 0
+    for id_filter in get_id_filters(ids):
+        for document in solr_iterate("documents", "*:*", fq=id_filter):
+            document["document_id"] = document["id"]
+            document["id"] = document["id"] + document.get("content_hash", "")
+            document.pop("_version_", None)
+            archive_updates.add(document)
+            count += 1
+    return count
+
+
+def get_scraped_content_hashes(ids, website):
+    """
+    Content hash of the documents with the given ids that are in the documents core, the other ids are left out.
+    The ids are looked up in the scraped content hashes and in Solr with one terms query per chunk. Hashes of
+    documents that are no longer in Solr are deleted. Documents in Solr without a scraped content hash (eg. indexed
+    by another path, or by a sync that failed before storing its hashes) get their content_hash in Solr, which is
+    stored for the website.
+    """
+    content_hashes = {
+        str(document_id): content_hash
+        for document_id, content_hash in ScrapedContentHash.objects.filter(pk__in=ids).values_list(
+            "id", "content_hash"
+        )
+    }
+    solr_hashes = {}
+    for id_filter in get_id_filters(ids):
+        for result in solr_iterate("documents", "*:*", fl="id,content_hash", fq=id_filter):
+            solr_hashes[result["id"]] = result.get("content_hash") or ""
+
+    stale_ids = [document_id for document_id in content_hashes if document_id not in solr_hashes]
+    if stale_ids:
+        logger.info("Removing %s scraped content hashes of documents that are not in Solr", len(stale_ids))
+        ScrapedContentHash.objects.filter(pk__in=stale_ids).delete()
+        for document_id in stale_ids:
+            del content_hashes[document_id]
+
+    missing_hashes = {
+        document_id: content_hash
+        for document_id, content_hash in solr_hashes.items()
+        if document_id not in content_hashes
+    }
+    if missing_hashes:
+        bulk_upsert(
+            ScrapedContentHash,
+            (
+                ScrapedContentHash(id=document_id, website=website, content_hash=content_hash)
+                for document_id, content_hash in missing_hashes.items()
+            ),
+            ["id"],
+            SCRAPED_CONTENT_HASH_FIELDS,
+        )
+        content_hashes.update(missing_hashes)
+    return content_hashes
 
 
 @shared_task
 def get_stats_for_html_size(website_id):
     core = "documents"
-    page_number = 0
-    rows_per_page = 250
-    cursor_mark = "*"
 
     website = Website.objects.get(pk=website_id)
     website_name = website.name.lower()
     q = QUERY_WEBSITE + website_name + " AND content_html:* AND acceptance_state:accepted"
 
     # Load all documents from Solr
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    options = {
-        "rows": rows_per_page,
-        "start": page_number,
-        "cursorMark": cursor_mark,
-        "sort": QUERY_ID_ASC,
-        "fl": "content_html,id",
-    }
-    documents = client.search(q, **options)
+    documents = solr_iterate(core, q, fl="content_html,id")
 
     size_1 = 0
     size_2 = 0
@@ -320,13 +383,96 @@ def score_documents_task(website_id, **kwargs):
     # lookup documents for website and score them
     website = Website.objects.get(pk=website_id)
     logger.info("Scoring documents with WEBSITE: " + website.name)
-    solr_documents = solr_search_website_with_content("documents", website.name, date=kwargs.get("date", None))
+    solr_documents = solr_search_website_with_content(
+        "documents", website.name, fl="id,content,pdf_docs", date=kwargs.get("date", None)
+    )
     use_pdf_files = True
     if website.name.lower() == "eurlex":
         use_pdf_files = False
     score_documents(website.name, solr_documents, use_pdf_files)
 
 
+def solr_doc_to_document_data(solr_doc, website):
+    """Django Document fields of a Solr document."""
+    solr_doc_date_types = solr_doc.get("dates_type", [""])
+    solr_doc_date_dates = solr_doc.get("dates", [""])
+    solr_doc_date_info = solr_doc.get("dates_info", [""])
+
+    solr_doc_date_of_effect = None
+    for date_info in solr_doc_date_info:
+        if date_info.lower().startswith("entry into force"):
+            index = solr_doc_date_info.index(date_info)
+            if solr_doc_date_types[index] == "date of effect":
+                solr_doc_date_of_effect = solr_doc_date_dates[index]
+                break
+
+    solr_doc_date = solr_doc.get("date", [datetime.now()])[0]
+    solr_doc_date_last_update = solr_doc.get("date_last_update", datetime.now())
+    # sanity check in case date_last_update was a solr array field
+    if isinstance(solr_doc_date_last_update, list):
+        solr_doc_date_last_update = solr_doc_date_last_update[0]
+    return {
+        "author": solr_doc.get("misc_author", [""])[0][:500],
+        "celex": solr_doc.get("celex", [""])[0][:20],
+        "custom_id": solr_doc.get("custom_id", [""])[0][:100],
+        "consolidated_versions": ",".join(x.strip() for x in solr_doc.get("consolidated_versions", [""])),
+        "date": solr_doc_date,
+        "date_of_effect": solr_doc_date_of_effect,
+        "date_last_update": solr_doc_date_last_update,
+        "eli": solr_doc.get("eli", [""])[0],
+        "file_url": solr_doc.get("file_url", [None])[0],
+        "status": solr_doc.get("status", [""])[0][:100],
+        "summary": "".join(x.strip() for x in solr_doc.get("summary", [""])),
+        "title": solr_doc.get("title", [""])[0][:1000],
+        "title_prefix": solr_doc.get("title_prefix", [""])[0],
+        "type": solr_doc.get("type", [""])[0],
+        "url": solr_doc["url"][0],
+        "various": "".join(x.strip() for x in solr_doc.get("various", [""])),
+        "website": website,
+    }
+
+
+SYNC_DOCUMENT_FIELDS = [
+    "author",
+    "celex",
+    "custom_id",
+    "consolidated_versions",
+    "date",
+    "date_of_effect",
+    "date_last_update",
+    "eli",
+    "file_url",
+    "status",
+    "summary",
+    "title",
+    "title_prefix",
+    "type",
+    "url",
+    "various",
+    "website",
+    "updated_at",
+]
+
+
+def update_offline_tags(how_many_days=30):
+    """Tag the documents that were not found while scraping in the last days OFFLINE, untag the others."""
+    cutoff = timezone.now() - timedelta(days=how_many_days)
+    # untag if the documents are now up to date
+    untagged = Tag.objects.filter(value="OFFLINE", document__date_last_update__gte=cutoff).delete()[0]
+    # tag documents that have not been updated in a while
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO {tag} (value, document_id) SELECT %s, d.id FROM {document} d "
+            "WHERE d.date_last_update <= %s AND NOT EXISTS "
+            "(SELECT 1 FROM {tag} t WHERE t.document_id = d.id AND t.value = %s)".format(
+                tag=Tag._meta.db_table, document=Document._meta.db_table
+            ),
+            ["OFFLINE", cutoff, "OFFLINE"],
+        )
+        tagged = cursor.rowcount
+    logger.info("Tagged %s documents OFFLINE, untagged %s documents", tagged, untagged)
+
+
 @shared_task
 def sync_documents_task(website_id, **kwargs):
     # lookup documents for website and sync them
@@ -336,84 +482,87 @@ def sync_documents_task(website_id, **kwargs):
 
     date = kwargs.get("date", None)
     solr_documents = solr_search_website_sorted(core="documents", website=website.name.lower(), date=date)
-    for solr_doc in solr_documents:
-
-        solr_doc_date_types = solr_doc.get("dates_type", [""])
-        solr_doc_date_dates = solr_doc.get("dates", [""])
-        solr_doc_date_info = solr_doc.get("dates_info", [""])
-
-        solr_doc_date_of_effect = None
-        for date_info in solr_doc_date_info:
-            if date_info.lower().startswith("entry into force"):
-                index = solr_doc_date_info.index(date_info)
-                if solr_doc_date_types[index] == "date of effect":
-                    solr_doc_date_of_effect = solr_doc_date_dates[index]
-                    break
-
-        solr_doc_date = solr_doc.get("date", [datetime.now()])[0]
-        solr_doc_date_last_update = solr_doc.get("date_last_update", datetime.now())
-        # sanity check in case date_last_update was a solr array field
-        if isinstance(solr_doc_date_last_update, list):
-            solr_doc_date_last_update = solr_doc_date_last_update[0]
-        data = {
-            "author": solr_doc.get("misc_author", [""])[0][:500],
-            "celex": solr_doc.get("celex", [""])[0][:20],
-            "custom_id": solr_doc.get("custom_id", [""])[0][:100],
-            "consolidated_versions": ",".join(x.strip() for x in solr_doc.get("consolidated_versions", [""])),
-            "date": solr_doc_date,
-            "date_of_effect": solr_doc_date_of_effect,
-            "date_last_update": solr_doc_date_last_update,
-            "eli": solr_doc.get("eli", [""])[0],
-            "file_url": solr_doc.get("file_url", [None])[0],
-            "status": solr_doc.get("status", [""])[0][:100],
-            "summary": "".join(x.strip() for x in solr_doc.get("summary", [""])),
-            "title": solr_doc.get("title", [""])[0][:1000],
-            "title_prefix": solr_doc.get("title_prefix", [""])[0],
-            "type": solr_doc.get("type", [""])[0],
-            "url": solr_doc["url"][0],
-            "various": "".join(x.strip() for x in solr_doc.get("various", [""])),
-            "website": website,
-        }
-        # Update or create the document, this returns a tuple with the django document and a boolean indicating
-        # whether or not the document was created
-        current_doc, current_doc_created = Document.objects.update_or_create(id=solr_doc["id"], defaults=data)
+    started = time.monotonic()
+    total = 0
+    for batch in iter_batches(solr_documents, BULK_BATCH_SIZE):
+        batch_started = time.monotonic()
+        documents = [Document(id=solr_doc["id"], **solr_doc_to_document_data(solr_doc, website)) for solr_doc in batch]
+        # Update or create the documents in one query, the fields that are not synced keep their value
+        bulk_upsert(Document, documents, ["id"], SYNC_DOCUMENT_FIELDS)
+        total += len(documents)
+        elapsed = max(time.monotonic() - batch_started, 0.001)
+        logger.info(
+            "Synced %s documents in %.2fs (%.0f documents/s), %s documents of %s in %.1fs",
+            len(documents),
+            elapsed,
+            len(documents) / elapsed,
+            total,
+            website.name,
+            time.monotonic() - started,
+        )
 
     if not date:
         # check for outdated documents based on last time a document was found during scraping
-        how_many_days = 30
-        outdated_docs = Document.objects.filter(date_last_update__lte=datetime.now() - timedelta(days=how_many_days))
-        up_to_date_docs = Document.objects.filter(date_last_update__gte=datetime.now() - timedelta(days=how_many_days))
-        # tag documents that have not been updated in a while
-        for doc in outdated_docs:
-            try:
-                Tag.objects.create(value="OFFLINE", document=doc)
-            except ValidationError as e:
-                # tag exists, skip
-                logger.debug(str(e))
-        # untag if the documents are now up to date
-        for doc in up_to_date_docs:
-            # fetch OFFLINE tag for this document
-            try:
-                offline_tag = Tag.objects.filter(value="OFFLINE", document=doc)
-                offline_tag.delete()
-            except Tag.DoesNotExist:
-                # OFFLINE tag not found, skip
-                pass
+        update_offline_tags()
+
+
+@shared_task
+def update_document_signatures_task(website_id):
+    # compute the MinHash signatures (near-duplicate index) of new and changed documents
+    website = Website.objects.get(pk=website_id)
+    signatures = {
+        str(document_id): (content_hash, source_hash)
+        for document_id, content_hash, source_hash in DocumentSignature.objects.filter(
+            document__website=website
+        ).values_list("document_id", "content_hash", "source_hash")
+    }
+    document_ids = set(str(doc_id) for doc_id in Document.objects.filter(website=website).values_list("id", flat=True))
+    # only fetch the content of the documents of which the scraped content hash changed
+    source_hashes = {}
+    for solr_doc in solr_iterate("documents", QUERY_WEBSITE + website.name.lower(), fl="id,content_hash"):
+        # only documents that are synced to django
+        if solr_doc["id"] not in document_ids:
+            continue
+        source_hash = solr_doc.get("content_hash") or ""
+        signature = signatures.get(solr_doc["id"])
+        if signature is None or not source_hash or signature[1] != source_hash:
+            source_hashes[solr_doc["id"]] = source_hash
+
+    updated = 0
+    for id_filter in get_id_filters(source_hashes.keys(), BULK_BATCH_SIZE):
+        for solr_doc in solr_iterate("documents", "*:*", fl="id,content", fq=id_filter):
+            if "content" not in solr_doc:
+                continue
+            content_hash = signatures.get(solr_doc["id"], ("", ""))[0]
+            if update_document_signature(
+                solr_doc["id"], solr_doc["content"][0], content_hash, source_hash=source_hashes[solr_doc["id"]]
+            ):
+                updated = updated + 1
+    logger.info(
+        "Updated %s document signatures for WEBSITE: %s, fetched the content of %s documents",
+        updated,
+        website.name,
+        len(source_hashes),
+    )
 
 
 @shared_task
 def delete_documents_not_in_solr_task(website_id):
     website = Website.objects.get(pk=website_id)
     # query Solr for available documents
-    solr_documents = solr_search_website_sorted(core="documents", website=website.name.lower())
+    solr_documents = solr_search_website_sorted(core="documents", website=website.name.lower(), fl="id")
     # delete django Documents that no longer exist in Solr
-    django_documents = list(Document.objects.filter(website=website))
-    django_doc_ids = [str(django_doc.id) for django_doc in django_documents]
-    solr_doc_ids = [solr_doc["id"] for solr_doc in solr_documents]
-    to_delete_doc_ids = set(django_doc_ids) - set(solr_doc_ids)
+    django_doc_ids = set(
+        str(doc_id) for doc_id in Document.objects.filter(website=website).values_list("id", flat=True)
+    )
+    solr_doc_ids = set(solr_doc["id"] for solr_doc in solr_documents)
+    to_delete_doc_ids = django_doc_ids - solr_doc_ids
     to_delete_docs = Document.objects.filter(pk__in=to_delete_doc_ids)
     logger.info("Deleting deprecated documents...")
     to_delete_docs.delete()
+    # documents that are scraped again are sent to Solr in full
+    stale_hashes = ScrapedContentHash.objects.filter(website=website).exclude(pk__in=solr_doc_ids)
+    logger.info("Deleted %s scraped content hashes", stale_hashes.delete()[0])
 
 
 @shared_task
@@ -467,14 +616,71 @@ def launch_crawler(spider, spider_type, date_start, date_end):
     reactor.run()  # the script will block here until the crawling is finished
 
 
+def parse_document_content(minio_client, result):
+    """
+    Plain text of a Solr document, parsed by Tika from its content_html or its pdf file in MinIO.
+    Returns (text or None, size in bytes of the parsed input).
+    """
+    if "content_html" in result:
+        data = result["content_html"][0].encode("utf-8")
+        if len(data) > PDF_MAX_SIZE_BYTES:
+            logger.warning("Skipped %s, content_html is larger than %s bytes", result["id"], PDF_MAX_SIZE_BYTES)
+            return None, len(data)
+        return parse_with_tika(data, timeout=TIKA_PARSE_TIMEOUT) or None, len(data)
+
+    # If there is more than 1 pdf, we rely on score_documents to extract
+    # the content of the pdf with the highest score
+    if "file_name" in result and len(result["file_name"]) == 1:
+        bucket_name = os.environ["MINIO_STORAGE_MEDIA_BUCKET_NAME"]
+        file_name = result["file_name"][0]
+        try:
+            object_info = minio_client.stat_object(bucket_name, file_name)
+            if object_info.size > PDF_MAX_SIZE_BYTES:
+                logger.warning("Skipped %s, '%s' is larger than %s bytes", result["id"], file_name, PDF_MAX_SIZE_BYTES)
+                return None, object_info.size
+            file_data = minio_client.get_object(bucket_name, file_name)
+            with tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_MEMORY) as output:
+                for d in file_data.stream(32 * 1024):
+                    output.write(d)
+                output.seek(0)
+                return parse_with_tika(output, timeout=TIKA_PARSE_TIMEOUT) or None, object_info.size
+        except ResponseError as err:
+            logger.error(err)
+        except NoSuchKey as err:
+            logger.warning("Could not find file '%s' in '%s", bucket_name, file_name)
+    return None, 0
+
+
+def timed_parse_document_content(minio_client, result):
+    start = time.monotonic()
+    content_text, size = parse_document_content(minio_client, result)
+    return content_text, size, time.monotonic() - start
+
+
+def log_parse_times(name, parse_times):
+    """Log a summary of the (seconds, id, size) parse times and the slowest documents."""
+    if not parse_times:
+        return
+    parse_times.sort(reverse=True)
+    seconds = [parse_time[0] for parse_time in parse_times]
+    logger.info(
+        "Parsed %s documents of %s in %.1fs of Tika time: median %.2fs, p95 %.2fs, max %.2fs",
+        len(parse_times),
+        name,
+        sum(seconds),
+        seconds[len(seconds) // 2],
+        seconds[int(len(seconds) * 0.05)],
+        seconds[0],
+    )
+    for parse_seconds, document_id, size in parse_times[:5]:
+        logger.info("Slowest parse: %s (%s bytes) took %.2fs", document_id, size, parse_seconds)
+
+
 @shared_task
 def parse_content_to_plaintext_task(website_id, **kwargs):
     website = Website.objects.get(pk=website_id)
     website_name = website.name.lower()
     logger.info("Adding content to each %s document.", website_name)
-    page_number = 0
-    rows_per_page = 250
-    cursor_mark = "*"
     date = kwargs.get("date", None)
     # select all records where content is empty and content_html is not
     q = '-content: ["" TO *] AND ( content_html: [* TO *] OR file_name: [* TO *] ) AND website:' + website_name
@@ -482,63 +688,62 @@ def parse_content_to_plaintext_task(website_id, **kwargs):
         q = q + " AND date:[" + date + " TO NOW]"  # eg. 2013-07-17T00:00:00Z
 
     core = "documents"
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    options = {"rows": rows_per_page, "start": page_number, "cursorMark": cursor_mark, "sort": QUERY_ID_ASC}
-    results = client.search(q, **options)
-    items = []
+    results = solr_iterate(core, q, fl="id,content_html,file_name")
+    solr_updates = SolrUpdateBuffer(core, name="parse content " + website_name)
     minio_client = Minio(
         os.environ["MINIO_STORAGE_ENDPOINT"],
         access_key=os.environ["MINIO_ACCESS_KEY"],
         secret_key=os.environ["MINIO_SECRET_KEY"],
         secure=False,
     )
-    for result in results:
-        # Parse content
-        content_text = None
-        if "content_html" in result:
-            output = parser.from_buffer(result["content_html"][0])
-            content_text = output["content"]
-        elif "file_name" in result:
-            # If there is more than 1 pdf, we rely on score_documents to extract
-            # the content of the pdf with the highest score
-            if len(result["file_name"]) == 1:
-                try:
-                    file_data = minio_client.get_object(
-                        os.environ["MINIO_STORAGE_MEDIA_BUCKET_NAME"], result["file_name"][0]
-                    )
-                    output = BytesIO()
-                    for d in file_data.stream(32 * 1024):
-                        output.write(d)
-                    content_text = parser.from_buffer(output.getvalue())
-                    if "content" in content_text:
-                        content_text = content_text["content"]
-                except ResponseError as err:
-                    print(err)
-                except NoSuchKey as err:
-                    logger.warn(
-                        "Could not find file '%s' in '%s",
-                        os.environ["MINIO_STORAGE_MEDIA_BUCKET_NAME"],
-                        result["file_name"][0],
-                    )
+    parse_times = []
+    pending = {}
 
-        # Store plaintext
-        if content_text is None:
-            # could not parse content
-            logger.info("No output for: %s, removing content", result["id"])
-        else:
-            logger.debug("Got content for: %s (%s)", result["id"], len(content_text))
-
-        # add to document model and save
-        document = {"id": result["id"], "content": {"set": content_text}}
-        items.append(document)
-
-        if len(items) == 1000:
-            logger.info("Got 1000 items, posting to solr")
-            client.add(items, commit=True)
-            items = []
+    def collect(futures):
+        for future in futures:
+            document_id = pending.pop(future)
+            try:
+                content_text, size, parse_seconds = future.result()
+            except TikaTimeout as err:
+                logger.error("Tika took longer than %s seconds for: %s, skipped", err, document_id)
+                continue
+            except requests.RequestException as err:
+                logger.error("Tika failed for: %s, skipped: %s", document_id, err)
+                continue
+            except Exception as err:
+                # one bad document must not discard the parsed content of the others
+                logger.exception("Failed to parse content of: %s, skipped: %s", document_id, err)
+                continue
+
+            parse_times.append((parse_seconds, document_id, size))
+            if parse_seconds > TIKA_SLOW_SECONDS:
+                logger.warning("Slow parse: %s (%s bytes) took %.2fs", document_id, size, parse_seconds)
+
+            # Store plaintext
+            if content_text is None:
+                # could not parse content
+                logger.info("No output for: %s, removing content", document_id)
+            else:
+                logger.debug("Got content for: %s (%s)", document_id, len(content_text))
+
+            # add to document model and save
+            document = {"id": document_id, "content": {"set": content_text}}
+            solr_updates.add(document)
+
+    # the next documents are read from the Solr cursor while the parses are running, the slowest documents don't
+    # hold up the others
+    with ThreadPoolExecutor(max_workers=TIKA_MAX_WORKERS) as executor:
+        for result in results:
+            pending[executor.submit(timed_parse_document_content, minio_client, result)] = result["id"]
+            if len(pending) >= 2 * TIKA_MAX_WORKERS:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(list(pending))
 
     # Send to solr
-    client.add(items, commit=True)
+    solr_updates.commit()
+    solr_updates.log_stats()
+    log_parse_times(website_name, parse_times)
 
 
 def is_document_english(plain_text):
@@ -582,55 +787,188 @@ def sync_scrapy_to_solr_task(website_id):
     create_bucket(minio_client, bucket_failed_name)
     core = "documents"
 
-    # Fetch existing id's
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    options = {"rows": 250000, "fl": "id,content_hash"}
-    results = client.search("website: " + website_name, **options)
-    content_ids = []
-    for result in results:
-        content_ids.append(result["id"])
-    logger.info("Found " + str(len(content_ids)) + " ids")
+    # existing id's and their content hash are looked up per batch of scraped items
+    # files are applied in listing order: a document in more than one file is only sent from the newest one,
+    # so files that are synced in parallel never race on the same id
+    object_names = [
+        obj.object_name
+        for obj in sorted(minio_client.list_objects(bucket_name), key=lambda obj: (obj.last_modified, obj.object_name))
+    ]
+    failed = []
+    changed_ids = set()
+    with ThreadPoolExecutor(max_workers=SCRAPY_SYNC_MAX_WORKERS) as executor:
+        futures = {
+            executor.submit(read_scrapy_object_ids, minio_client, bucket_name, object_name): object_name
+            for object_name in object_names
+        }
+        object_ids = {}
+        # other errors (eg. a lost connection) are raised: nothing is sent and the files stay in the bucket, so
+        # no later file is synced before them
+        for future in as_completed(futures):
+            try:
+                object_ids[futures[future]] = future.result()
+            except (jsonlines.InvalidLineError, KeyError, TypeError) as err:
+                logger.error("Failed to parse %s, MOVE to '%s': %s", futures[future], bucket_failed_name, err)
+                move_scrapy_object(minio_client, bucket_name, futures[future], bucket_failed_name)
+                failed.append(futures[future])
+        newest_objects = {}
+        for object_name in object_names:
+            for document_id in object_ids.get(object_name, []):
+                newest_objects[document_id] = object_name
+        del object_ids
+
+        futures = {
+            executor.submit(
+                sync_scrapy_object_to_solr, minio_client, core, bucket_name, object_name, website, newest_objects
+            ): object_name
+            for object_name in object_names
+            if object_name not in failed
+        }
+        for future in as_completed(futures):
+            try:
+                changed_ids.update(future.result())
+            except Exception as err:
+                logger.error("Failed to sync %s: %s", futures[future], err)
+                failed.append(futures[future])
+
+    # the next stages only process documents without a score or extracted with another version
+    for chunk in chunks(list(changed_ids), BULK_BATCH_SIZE):
+        Document.objects.filter(pk__in=chunk).update(
+            acceptance_state_max_probability=None, extract_terms_nlp_version="", extract_ro_nlp_version=""
+        )
+    logger.info("Flagged %s changed documents of %s for processing", len(changed_ids), website_name)
+
+    if failed:
+        raise Exception("Failed to sync {} of {} files of {}".format(len(failed), len(object_names), website_name))
+
+
+SCRAPY_IDS_SELECT_OPTIONS = SelectObjectOptions(
+    expression="SELECT s.id FROM S3Object s",
+    input_serialization=InputSerialization(json=JSONInput(json_type="LINES")),
+    output_serialization=OutputSerialization(csv=CSVOutput()),
+    request_progress=RequestProgress(enabled=False),
+)
+
+
+def move_scrapy_object(minio_client, bucket_name, object_name, target_bucket_name):
+    minio_client.copy_object(target_bucket_name, object_name, bucket_name + "/" + object_name)
+    minio_client.remove_object(bucket_name, object_name)
 
+
+def read_scrapy_object_ids(minio_client, bucket_name, object_name):
+    """
+    Ids of the scraped documents in a jsonlines file. MinIO selects the ids (S3 Select), so only the ids are
+    downloaded. When MinIO can't select them the file is read here, a line that isn't a JSON object with an id
+    raises InvalidLineError, KeyError or TypeError.
+    """
+    ids = []
+    tail = ""
     try:
-        objects = minio_client.list_objects(bucket_name)
-        for obj in objects:
-            # Fetch jsonlines file
-            logger.info("Working on %s", obj.object_name)
-            file_data = minio_client.get_object(bucket_name, obj.object_name)
-            updated_items = 0
-            new_items = 0
-            results = []
-            # a json-line file may contain up to 1000 json documents (memory issue ?)
-            with jsonlines.Reader(BytesIO(file_data.data)) as reader:
-                for json in reader:
-                    if json["id"] in content_ids:
-                        updated_items = updated_items + 1
-                        results.append(rewrite_json_doc_to_update(json))
-                    else:
-                        new_items = updated_items + 1
-                        results.append(json)
-                    if len(results) == 1000:
-                        # Update solr index
-                        client.add(results, commit=True)
-                        results = []
-
-            logger.info("Found " + str(updated_items) + " updated items")
-            logger.info("Found " + str(new_items) + " new items")
-
-            # Update solr index one last time
-            client.add(results, commit=True)
-
-            # move jsonlines file to archive
-            logger.info("ALL good, MOVE to '%s'", bucket_archive_name)
-            minio_client.copy_object(bucket_archive_name, obj.object_name, bucket_name + "/" + obj.object_name)
-            minio_client.remove_object(bucket_name, obj.object_name)
-
-    except Exception as err:
-        # move jsonlines file to failed folder
-        logger.info("FAILED, MOVE to '%s'", bucket_failed_name)
-        minio_client.copy_object(bucket_failed_name, obj.object_name, bucket_name + "/" + obj.object_name)
-        minio_client.remove_object(bucket_name, obj.object_name)
+        select_ids = minio_client.select_object_content(bucket_name, object_name, SCRAPY_IDS_SELECT_OPTIONS)
+        try:
+            for data in select_ids.stream():
+                lines = (tail + data).split("\n")
+                tail = lines.pop()
+                ids.extend(line for line in lines if line)
+        finally:
+            select_ids.close()
+        if tail:
+            ids.append(tail)
+        return ids
+    except SelectMessageError as err:
+        logger.warning("Could not select the ids of %s, reading the file: %s", object_name, err)
+
+    file_data = minio_client.get_object(bucket_name, object_name)
+    try:
+        with jsonlines.Reader(file_data) as reader:
+            return [json["id"] for json in reader]
+    finally:
+        file_data.close()
+        file_data.release_conn()
+
+
+def sync_scrapy_object_to_solr(minio_client, core, bucket_name, object_name, website, newest_objects):
+    """
+    Send the scraped documents of a jsonlines file to Solr and move the file to the archive bucket.
+    The file is streamed from MinIO in batches and committed at the end, it is moved to the failed bucket when it
+    could not be sent. Documents of which newest_objects names another file are skipped, that file has the newest
+    version.
+
+    A Solr commit is core-wide: batches that were already flushed become visible with the commit of any other
+    file, so a file that fails halfway may leave part of its updates in Solr. Its scraped content hashes are not
+    stored, moving it back from the failed bucket compares its documents with Solr and sends the changes again.
+
+    Documents that are in Solr with the same content hash only get their date_last_update updated, documents in
+    Solr with another content hash are updated and their plain text content is removed, so it is parsed again.
+    Only documents that are not in Solr are added in full. The scraped content hashes of the new and changed
+    documents are stored when the file is archived.
+    Returns the ids of the changed documents.
+    """
+    logger.info("Working on %s", object_name)
+    solr_updates = SolrUpdateBuffer(core, name="scrapy sync " + object_name, commit_within=None)
+    changed_ids = []
+    # the last version of a document that is scraped more than once wins
+    scraped_hashes = {}
+    unchanged_items = 0
+    new_items = 0
+    try:
+        file_data = minio_client.get_object(bucket_name, object_name)
+        try:
+            with jsonlines.Reader(file_data) as reader:
+                items = (json for json in reader if newest_objects.get(json["id"]) == object_name)
+                for batch in iter_batches(items, BULK_BATCH_SIZE):
+                    content_hashes = get_scraped_content_hashes([json["id"] for json in batch], website)
+                    for json in batch:
+                        content_hash = json.get("content_hash") or ""
+                        if json["id"] not in content_hashes:
+                            new_items = new_items + 1
+                            solr_updates.add(json)
+                        elif content_hash and content_hash == content_hashes[json["id"]]:
+                            # still online, see the OFFLINE tag in sync_documents_task
+                            unchanged_items = unchanged_items + 1
+                            if "date_last_update" in json:
+                                solr_updates.add(
+                                    {"id": json["id"], "date_last_update": {"set": json["date_last_update"]}}
+                                )
+                            continue
+                        else:
+                            changed_ids.append(json["id"])
+                            if "content" not in json:
+                                json["content"] = None
+                            solr_updates.add(rewrite_json_doc_to_update(json))
+                        scraped_hashes[json["id"]] = ScrapedContentHash(
+                            id=json["id"], website=website, content_hash=content_hash
+                        )
+        finally:
+            file_data.close()
+            file_data.release_conn()
+
+        logger.info("Found " + str(len(changed_ids)) + " updated items in " + object_name)
+        logger.info("Found " + str(unchanged_items) + " unchanged items in " + object_name)
+        logger.info("Found " + str(new_items) + " new items in " + object_name)
+
+        # Make sure Solr accepted this file before archiving it
+        solr_updates.commit()
+        solr_updates.log_stats()
+    except Exception:
+        # move jsonlines file to failed folder, its pending updates are not sent
+        solr_updates.discard()
+        logger.info("FAILED, MOVE to '%s'", bucket_name + "-failed")
+        move_scrapy_object(minio_client, bucket_name, object_name, bucket_name + "-failed")
         raise
+    else:
+        # move jsonlines file to archive, with the scraped content hashes of its documents
+        logger.info("ALL good, MOVE to '%s'", bucket_name + "-archive")
+        move_scrapy_object(minio_client, bucket_name, object_name, bucket_name + "-archive")
+        try:
+            bulk_upsert(ScrapedContentHash, scraped_hashes.values(), ["id"], SCRAPED_CONTENT_HASH_FIELDS)
+        except DatabaseError as err:
+            # the next sync compares with the content_hash in Solr
+            logger.error("Failed to store the scraped content hashes of %s: %s", object_name, err)
+        return changed_ids
+    finally:
+        # runs in a worker thread, its database connection would stay open in the celery worker
+        connection.close()
 
 
 def rewrite_json_doc_to_update(doc):
@@ -644,33 +982,62 @@ def rewrite_json_doc_to_update(doc):
 def check_documents_unvalidated_task(website_id):
     website = Website.objects.get(pk=website_id)
     logger.info("Set unvalidated field for all documents for website: %s", str(website))
-    docs = Document.objects.filter(website=website)
-    for doc in docs:
-        # get all acceptance states that are not unvalidated
-        validated_states = AcceptanceState.objects.filter(document=doc).exclude(value=AcceptanceStateValue.UNVALIDATED)
-        # update document unvalidated state accordingly
-        if not validated_states:
-            doc.unvalidated = True
-        else:
-            doc.unvalidated = False
-        doc.save()
+    updated = update_documents_unvalidated(Document.objects.filter(website=website))
+    logger.info("Updated unvalidated field of %s documents for website: %s", updated, str(website))
+
+
+def assign_custom_ids(document_ids, identifiers):
+    """
+    Store the custom ids of documents given their identifiers. Documents that share an identifier are numbered in
+    the database in id order: the first one keeps the identifier, the others get a _2, _3, ... suffix. Identifiers
+    are cut to the 100 characters of the field before they are compared, and again to fit the suffix.
+    Returns a dict from document id to custom id and the number of documents of which the custom id changed.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "WITH identifiers AS (SELECT id, CASE WHEN identifier = '' OR n = 1 THEN identifier "
+            "ELSE left(identifier, 100 - length('_' || n)) || '_' || n END AS custom_id "
+            "FROM (SELECT id, left(identifier, 100) AS identifier, "
+            "row_number() OVER (PARTITION BY left(identifier, 100) ORDER BY id) AS n "
+            "FROM unnest(%s::uuid[], %s::text[]) AS t (id, identifier)) AS numbered), "
+            "updated AS (UPDATE {document} d SET custom_id = i.custom_id, updated_at = %s FROM identifiers i "
+            "WHERE d.id = i.id AND d.custom_id <> i.custom_id RETURNING d.id) "
+            "SELECT id, custom_id, (SELECT count(*) FROM updated) FROM identifiers".format(
+                document=Document._meta.db_table
+            ),
+            [list(document_ids), list(identifiers), timezone.now()],
+        )
+        rows = cursor.fetchall()
+    return {str(document_id): custom_id for document_id, custom_id, _ in rows}, rows[0][2] if rows else 0
 
 
 @shared_task
 def update_documents_custom_id_task(website_id):
     website = Website.objects.get(pk=website_id)
     logger.info("Set custom_id field for all documents for website: %s", str(website))
-    solr_documents = solr_search_website_with_content("documents", website.name)
-    for doc in solr_documents:
-        if "content" in doc:
-            custom_id = retrieve_identifier(doc)
-            logger.debug(custom_id)
-            django_doc = Document.objects.get(pk=str(doc["id"]))
-            django_doc.custom_id = custom_id
-            django_doc.save()
-            solr_client = pysolr.Solr(os.environ["SOLR_URL"] + "/documents")
-            document = {"id": str(doc["id"]), "custom_id": {"set": custom_id}}
-            solr_client.add(document, commit=True)
+    solr_custom_ids = {}
+
+    def read_documents():
+        for doc in solr_search_website_content_head("documents", website.name, fl="id,url,custom_id"):
+            solr_custom_ids[doc["id"]] = doc.get("custom_id", [""])[0]
+            yield doc["id"], doc.get("url", [""])[0], doc["content"][0]
+
+    # the regular expressions run in child processes, billiard can start them from a celery worker process
+    with Pool(CUSTOM_ID_PROCESSES) as pool:
+        identifiers = dict(pool.imap(retrieve_identifier_of_doc, read_documents(), chunksize=CUSTOM_ID_CHUNK_SIZE))
+    custom_ids, updated = assign_custom_ids(identifiers.keys(), identifiers.values())
+
+    with SolrUpdateBuffer("documents", name="custom id " + website.name) as solr_updates:
+        for document_id, custom_id in custom_ids.items():
+            if solr_custom_ids.get(document_id) != custom_id:
+                solr_updates.add({"id": document_id, "custom_id": {"set": custom_id}})
+    logger.info(
+        "Set custom_id of %s documents for website: %s, %s changed in Django, %s in Solr",
+        len(custom_ids),
+        str(website),
+        updated,
+        solr_updates.documents,
+    )
 
 
 def create_bucket(client, name):
@@ -3,7 +3,6 @@ import logging
 import os
 from io import BytesIO
 
-import pysolr
 import requests
 from celery import shared_task, chain
 from django.core.serializers import serialize
@@ -14,6 +13,7 @@ from tika import parser
 from scheduler.extract import extract_terms_for_document, fetch_typesystem, extract_reporting_obligations
 from searchapp.datahandling import classify
 from searchapp.models import Website, Document, AcceptanceState, AcceptanceStateValue
+from searchapp.solr_call import get_solr_client
 
 logger = logging.getLogger(__name__)
 workpath = os.path.dirname(os.path.abspath(__file__))
@@ -134,7 +134,7 @@ def parse_content_to_plaintext(document_id):
         secret_key=os.environ["MINIO_SECRET_KEY"],
         secure=False,
     )
-    solr_client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
+    solr_client = get_solr_client(core)
 
     # Parse content
     content_text = None
@@ -172,7 +172,7 @@ def score_document(document_json):
     DJANGO_ERROR_SCORE = -1
     ACCEPTED_THRESHOLD = 0.5
     core = "documents"
-    solr_client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
+    solr_client = get_solr_client(core)
     classifier_response = classify(document_json["id"], document_json["content"], "pdf")
     accepted_probability = classifier_response["accepted_probability"]
     # Check acceptance
@@ -1,8 +1,20 @@
-from django.test import TestCase
+import inspect
+import uuid
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
 
 from cassis.typesystem import load_typesystem
 from cassis.xmi import load_cas_from_xmi
-from unittest import skip
+from unittest import skip, skipUnless
+
+from minio import Minio
+from minio.definitions import UploadPart
+
+from scheduler.extract_identifiers import retrieve_identifier
+from scheduler.minio_upload import MIN_PART_SIZE, MultipartWriter
+from scheduler.tasks import assign_custom_ids
+from searchapp.models import Document, Website
 
 # Create your tests here.
 class ExtractTerms(TestCase):
@@ -59,3 +71,113 @@ class ExtractTerms(TestCase):
             print("")
 
         self.assertEqual(num_defi, 39)
+
+
+class RetrieveIdentifier(SimpleTestCase):
+    def test_identifier(self):
+        self.assertEqual(
+            retrieve_identifier("https://www.esma.europa.eu/x", "ESMA33-128-563 Guidelines"), "ESMA33-128-563"
+        )
+        self.assertEqual(retrieve_identifier("https://www.fsb.org/x", "Published 12 March 2020"), "FSB_12_March_2020")
+        # an identifier without a number is replaced with the date in the content
+        self.assertEqual(
+            retrieve_identifier("https://www.esma.europa.eu/x", "Report ESMA-Guidelines of\n3 June\xa02019"),
+            "ESMA_3_June_2019",
+        )
+        # without a date the name in the url is used
+        self.assertEqual(retrieve_identifier("https://www.fsb.org/wp/p120320.pdf", "no date"), "FSB_p120320")
+
+    def test_no_identifier(self):
+        self.assertEqual(retrieve_identifier("https://example.com/report", "12 March 2020"), "")
+        self.assertEqual(retrieve_identifier("https://www.esma.europa.eu/x", "Final report ESMA-Guidelines"), "")
+        self.assertEqual(retrieve_identifier("https://www.fsb.org/wp/%%%.pdf", "no date"), "")
+
+
+@skipUnless(connection.vendor == "postgresql", "Custom ids are numbered with postgres arrays")
+class AssignCustomIds(TestCase):
+    def setUp(self):
+        website = Website.objects.create(name="EBA", url="https://eba.europa.eu")
+        self.ids = sorted(str(uuid.uuid4()) for _ in range(6))
+        for i, document_id in enumerate(self.ids):
+            Document.objects.create(
+                id=document_id, title=str(i), url="https://eba.europa.eu/" + str(i), website=website
+            )
+
+    def test_duplicates(self):
+        identifiers = ["EBA_GL", "EBA_GL", "", "E" * 100, "E" * 100, "E" * 100 + "X"]
+        # the numbering follows the document ids, not the order of the arguments
+        custom_ids, updated = assign_custom_ids(self.ids[::-1], identifiers[::-1])
+        # identifiers are compared on the length of the field and cut to fit the suffix
+        expected = ["EBA_GL", "EBA_GL_2", "", "E" * 100, "E" * 98 + "_2", "E" * 98 + "_3"]
+        self.assertEqual(custom_ids, dict(zip(self.ids, expected)))
+        self.assertEqual(updated, 5)
+        self.assertEqual(list(Document.objects.order_by("id").values_list("custom_id", flat=True)), expected)
+
+        custom_ids, updated = assign_custom_ids(self.ids, identifiers)
+        self.assertEqual(custom_ids, dict(zip(self.ids, expected)))
+        self.assertEqual(updated, 0)
+
+
+class FakeMinio:
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+
+    def put_object(self, bucket_name, object_name, data, length, content_type=None):
+        self.objects[object_name] = data.read(length)
+
+    def _new_multipart_upload(self, bucket_name, object_name, metadata):
+        self.uploads[object_name] = {}
+        return object_name
+
+    def _do_put_object(self, bucket_name, object_name, data, length, upload_id, part_number):
+        self.uploads[upload_id][part_number] = data
+        return str(part_number), None
+
+    def _complete_multipart_upload(self, bucket_name, object_name, upload_id, parts):
+        upload = self.uploads.pop(upload_id)
+        self.objects[object_name] = b"".join(upload[part_number] for part_number in sorted(parts))
+
+    def _remove_incomplete_upload(self, bucket_name, object_name, upload_id):
+        del self.uploads[upload_id]
+
+
+class MultipartWriterTest(SimpleTestCase):
+    def test_minio_multipart_api(self):
+        # private minio methods, they have to be checked when minio is upgraded
+        methods = {
+            "_new_multipart_upload": ["bucket_name", "object_name", "metadata"],
+            "_do_put_object": ["bucket_name", "object_name", "part_data", "part_size", "upload_id", "part_number"],
+            "_complete_multipart_upload": ["bucket_name", "object_name", "upload_id", "uploaded_parts"],
+            "_remove_incomplete_upload": ["bucket_name", "object_name", "upload_id"],
+        }
+        for name, parameters in methods.items():
+            self.assertTrue(hasattr(Minio, name), name)
+            signature = inspect.signature(getattr(Minio, name))
+            self.assertEqual(list(signature.parameters)[1 : len(parameters) + 1], parameters)
+        self.assertEqual(
+            list(inspect.signature(UploadPart).parameters),
+            ["bucket_name", "object_name", "upload_id", "part_number", "etag", "last_modified", "size"],
+        )
+
+    def test_upload(self):
+        client = FakeMinio()
+        data = bytes(range(256)) * (MIN_PART_SIZE // 100)
+        with MultipartWriter(client, "export", "large.zip") as writer:
+            for start in range(0, len(data), 1000000):
+                writer.write(data[start : start + 1000000])
+        self.assertEqual(client.objects["large.zip"], data)
+        self.assertEqual(client.uploads, {})
+
+        with MultipartWriter(client, "export", "small.zip") as writer:
+            writer.write(b"small")
+        self.assertEqual(client.objects["small.zip"], b"small")
+
+    def test_abort(self):
+        client = FakeMinio()
+        with self.assertRaises(ValueError):
+            with MultipartWriter(client, "export", "failed.zip") as writer:
+                writer.write(bytes(MIN_PART_SIZE + 1))
+                raise ValueError
+        self.assertEqual(client.objects, {})
+        self.assertEqual(client.uploads, {})
@@ -8,7 +8,7 @@ from django.contrib.auth.models import User
 from admin_rest.models import site as rest_site
 from scheduler import tasks
 from scheduler.extract import send_document_to_webanno
-from .models import Website, Attachment, Document, AcceptanceState, Comment, Tag
+from .models import Website, Attachment, Document, AcceptanceState, Comment, Tag, ScrapedContentHash
 
 logger = logging.getLogger(__name__)
 
@@ -104,6 +104,8 @@ def delete_from_solr(modeladmin, request, queryset):
             data='{"delete": {"query": "website:' + website.name.lower() + '"}}',
         )
         logger.info("Deleted solr content for website: %s => %s", website.name.lower(), r.json())
+        # the next sync sends every scraped document in full
+        ScrapedContentHash.objects.filter(website=website).delete()
 
 
 def export_all_user_data(modeladmin, request, queryset):
@@ -179,6 +181,11 @@ class DocumentAdmin(admin.ModelAdmin):
         export_all_user_data_document,
     ]
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if change:
+            obj.update_solr_on_commit()
+
 
 class AcceptanceStateAdmin(admin.ModelAdmin):
     autocomplete_fields = ["document"]
@@ -0,0 +1,57 @@
+"""
+Bulk database helpers for the scheduler tasks.
+"""
+import itertools
+import os
+
+from django.db import connection, models
+
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", 500))
+
+
+def iter_batches(iterable, size=BULK_BATCH_SIZE):
+    """Yield successive lists of at most size items from any iterable (also generators)."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def bulk_upsert(model, objs, unique_fields, update_fields, batch_size=BULK_BATCH_SIZE):
+    """
+    Insert model instances, updating update_fields of the rows that conflict on unique_fields.
+    Postgres INSERT ... ON CONFLICT, unique_fields must match a unique constraint of the model.
+    Auto increment primary keys are left to the database, save() and signals are not called.
+    Returns the number of inserted or updated rows.
+    """
+    opts = model._meta
+    quote_name = connection.ops.quote_name
+    fields = [field for field in opts.concrete_fields if not isinstance(field, models.AutoField)]
+    columns = ", ".join(quote_name(field.column) for field in fields)
+    conflict_columns = ", ".join(quote_name(opts.get_field(name).column) for name in unique_fields)
+    updates = ", ".join(
+        "{column} = EXCLUDED.{column}".format(column=quote_name(opts.get_field(name).column)) for name in update_fields
+    )
+    placeholders = "(" + ", ".join(["%s"] * len(fields)) + ")"
+
+    count = 0
+    for batch in iter_batches(objs, batch_size):
+        params = []
+        for obj in batch:
+            for field in fields:
+                # pre_save fills in auto_now fields
+                params.append(field.get_db_prep_save(field.pre_save(obj, True), connection))
+        sql = "INSERT INTO {table} ({columns}) VALUES {values} ON CONFLICT ({conflict}) DO UPDATE SET {updates}"
+        sql = sql.format(
+            table=quote_name(opts.db_table),
+            columns=columns,
+            values=", ".join([placeholders] * len(batch)),
+            conflict=conflict_columns,
+            updates=updates,
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            count += cursor.rowcount
+    return count
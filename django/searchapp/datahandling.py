@@ -3,20 +3,29 @@ import json
 import logging
 import operator
 import os
-import random
-import gzip
-import pysolr
+import hashlib
+import threading
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import requests
-from django.db.models import Q
-from glossary.models import ConceptDefined
-from tika import parser
+from requests.adapters import HTTPAdapter
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Count, Exists, Max, OuterRef, Q, Subquery
+from django.utils import timezone
+from glossary.models import AnnotationWorklog, ConceptDefined
 
-from obligations.models import ReportingObligationOffsets
-from scheduler.extract import fetch_typesystem
-from cassis import load_typesystem, load_cas_from_xmi
+from obligations.models import ReportingObligationOffsets, ROAnnotationWorklog
+from scheduler.cas_cache import get_cas
+from scheduler.extract import EXTRACT_RO_NLP_VERSION, EXTRACT_TERMS_NLP_VERSION, fetch_typesystem
+from cassis import load_typesystem
 from minio import Minio, ResponseError
-from minio.error import BucketAlreadyOwnedByYou, BucketAlreadyExists, NoSuchKey
-from searchapp.models import Document, Website, AcceptanceState, AcceptanceStateValue
+from minio.error import NoSuchBucket, NoSuchKey
+from searchapp.models import Document, Website, AcceptanceState, AcceptanceStateValue, ClassifierResult
+from searchapp.bulk import BULK_BATCH_SIZE, bulk_upsert, iter_batches
+from searchapp.pdf_text import extract_pdf_text, get_pdf_text_stats
+from searchapp.solr_call import SolrUpdateBuffer
 
 logger = logging.getLogger(__name__)
 workpath = os.path.dirname(os.path.abspath(__file__))
@@ -25,50 +34,218 @@ RO_SPAN_OPEN_TAG = '<span class="highlight_ro">'
 TERM_SPAN_OPEN_TAG = '<span class="highlight_term">'
 SPAN_CLOSE_TAG = "</span>"
 
+# Number of classifier requests that are running at the same time
+CLASSIFIER_MAX_IN_FLIGHT = int(os.environ.get("CLASSIFIER_MAX_IN_FLIGHT", 4))
+# Connect and read timeout in seconds of a classifier request
+CLASSIFIER_CONNECT_TIMEOUT = float(os.environ.get("CLASSIFIER_CONNECT_TIMEOUT", 10))
+CLASSIFIER_TIMEOUT = float(os.environ.get("CLASSIFIER_TIMEOUT", 300))
+# Cached classifier scores are only valid for the same classifier model, it must be bumped with every model
+# deployment, see secrets/django-docker.env.sample
+DOCUMENT_CLASSIFIER_VERSION = os.environ.get("DOCUMENT_CLASSIFIER_VERSION", "1")
+# if the classifier returns this value as either accepted or rejected
+# probability, it means something went wrong decoding the content
+CLASSIFIER_ERROR_SCORE = -9999
+AUTO_CLASSIFIER = "auto classifier"
+# Number of documents of which the unvalidated flag is recomputed in one statement
+UNVALIDATED_CHUNK_SIZE = int(os.environ.get("UNVALIDATED_CHUNK_SIZE", 5000))
+# Compressed CAS files larger than this are not annotated
+ANNOTATION_MAX_CAS_SIZE = int(os.environ.get("ANNOTATION_MAX_CAS_SIZE", 10 * 1000 * 1000))
+ANNOTATION_CACHE_ALIAS = os.environ.get("ANNOTATION_CACHE_ALIAS", "default")
+ANNOTATION_CACHE_TIMEOUT = int(os.environ.get("ANNOTATION_CACHE_TIMEOUT", 24 * 60 * 60))
+
+_classifier_session = None
+_classifier_session_lock = threading.Lock()
+_classifier_cache_stats = Counter()
+
+
+def _reset_classifier_session():
+    # connections can't be shared with a forked child
+    global _classifier_session
+    _classifier_session = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_classifier_session)
+
+
+def get_classifier_session():
+    """Shared keep-alive session for the document classifier, with a connection per request in flight."""
+    global _classifier_session
+    if _classifier_session is None:
+        with _classifier_session_lock:
+            if _classifier_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=CLASSIFIER_MAX_IN_FLIGHT)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _classifier_session = session
+    return _classifier_session
+
+
+def classify_concurrently(jobs, max_in_flight=CLASSIFIER_MAX_IN_FLIGHT):
+    """
+    Classify the contents of (key, [(django_doc_id, content, content_type), ...]) jobs on a thread pool.
+    Yields (key, [classifier response, ...]) in the order of the jobs. At most max_in_flight jobs are submitted
+    ahead of the one that is yielded, so the contents held in memory stay bounded.
+
+    The classifier cache is read and written in the calling thread, the worker threads only do the requests.
+    """
+    pending = deque()
+
+    def collect():
+        key, submitted = pending.popleft()
+        responses = []
+        for content_hash, content_type, future in submitted:
+            response = future.result()
+            if content_hash:
+                cache_classification(content_hash, content_type, response["accepted_probability"])
+            responses.append(response)
+        return key, responses
+
+    with ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="classify") as executor:
+        for key, contents in jobs:
+            submitted = []
+            for django_doc_id, content, content_type in contents:
+                content_hash = get_content_hash(content)
+                accepted_probability = get_cached_classification(content_hash, content_type)
+                if accepted_probability is not None:
+                    future = Future()
+                    future.set_result({"accepted_probability": accepted_probability, "content": content})
+                    # nothing to store
+                    content_hash = None
+                else:
+                    future = executor.submit(request_classification, django_doc_id, content, content_type)
+                submitted.append((content_hash, content_type, future))
+            pending.append((key, submitted))
+            while len(pending) >= max_in_flight:
+                yield collect()
+        while pending:
+            yield collect()
+
+
+def save_scores(scores):
+    """
+    Store the auto classifier results of a batch of (document, accepted_probability, status, index) tuples:
+    one bulk update of the documents and one upsert of their auto classifier AcceptanceState, in one
+    transaction. The unvalidated flag is set like AcceptanceState.save does.
+    """
+    if not scores:
+        return
+    document_ids = [document.id for document, _, _, _ in scores]
+    # documents with a validated state from a user
+    validated_ids = set(
+        AcceptanceState.objects.filter(document_id__in=document_ids)
+        .exclude(value=AcceptanceStateValue.UNVALIDATED)
+        .exclude(probability_model=AUTO_CLASSIFIER)
+        .values_list("document_id", flat=True)
+    )
+    now = timezone.now()
+    documents = []
+    acceptance_states = []
+    for document, accepted_probability, classifier_status, accepted_probability_index in scores:
+        document.acceptance_state_max_probability = accepted_probability
+        document.unvalidated = (
+            classifier_status == AcceptanceStateValue.UNVALIDATED and document.id not in validated_ids
+        )
+        document.updated_at = now
+        documents.append(document)
+        acceptance_states.append(
+            AcceptanceState(
+                probability_model=AUTO_CLASSIFIER,
+                document=document,
+                value=classifier_status,
+                accepted_probability=accepted_probability,
+                accepted_probability_index=accepted_probability_index,
+            )
+        )
+    with transaction.atomic():
+        Document.objects.bulk_update(documents, ["acceptance_state_max_probability", "unvalidated", "updated_at"])
+        bulk_upsert(
+            AcceptanceState,
+            acceptance_states,
+            unique_fields=["document", "probability_model"],
+            update_fields=["value", "accepted_probability", "accepted_probability_index", "updated_at"],
+        )
+
+
+def update_documents_unvalidated(documents, chunk_size=UNVALIDATED_CHUNK_SIZE):
+    """
+    Recompute the unvalidated flag of a Document queryset: a document is unvalidated when none of its acceptance
+    states is validated. Only documents of which the flag changes are updated, with two UPDATE statements per
+    primary key range of chunk_size documents so the row locks are held shortly. Use it after bulk changes of
+    acceptance states, that don't go through AcceptanceState.save.
+    Returns the number of updated documents.
+    """
+    validated_states = AcceptanceState.objects.filter(document=OuterRef("pk")).exclude(
+        value=AcceptanceStateValue.UNVALIDATED
+    )
+    documents = documents.order_by("pk")
+    updated = 0
+    lower = None
+    while True:
+        chunk = documents if lower is None else documents.filter(pk__gt=lower)
+        upper = list(chunk.values_list("pk", flat=True)[chunk_size - 1 : chunk_size])
+        if upper:
+            chunk = chunk.filter(pk__lte=upper[0])
+        now = timezone.now()
+        updated += chunk.filter(Exists(validated_states), unvalidated=True).update(unvalidated=False, updated_at=now)
+        updated += chunk.filter(~Exists(validated_states), unvalidated=False).update(unvalidated=True, updated_at=now)
+        if not upper:
+            return updated
+        lower = upper[0]
+
 
 def score_documents(website_name, solr_documents, use_pdf_files):
-    # if the classifier returns this value as either accepted or rejected
-    # probability, it means something went wrong decoding the content
-    CLASSIFIER_ERROR_SCORE = -9999
     DJANGO_ERROR_SCORE = -1
     ACCEPTED_THRESHOLD = 0.5
-    score_updates = []
-    content_updates = []
     core = "documents"
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    # loop documents
-    for solr_doc in solr_documents:
-        django_doc = Document.objects.get(pk=solr_doc["id"])
-        # Skip documents already processed
-        if django_doc.acceptance_state_max_probability != None:
-            continue
-        content = ""
+    # scores and (pdf) content are posted in bulk, committed once at the end
+    solr_updates = SolrUpdateBuffer(core, name="score " + website_name)
+
+    def classifier_jobs():
+        for solr_docs in iter_batches(solr_documents):
+            # one query for the django documents of the batch, documents already processed are skipped
+            django_docs = (
+                Document.objects.filter(pk__in=[solr_doc["id"] for solr_doc in solr_docs])
+                .filter(acceptance_state_max_probability__isnull=True)
+                .only("id")
+                .in_bulk()
+            )
+            django_docs = {str(doc_id): django_doc for doc_id, django_doc in django_docs.items()}
+            for solr_doc in solr_docs:
+                doc_id = str(solr_doc["id"])
+                django_doc = django_docs.get(doc_id)
+                if django_doc is None:
+                    continue
+                if use_pdf_files and solr_doc.get("pdf_docs"):
+                    if solr_doc.get("content") and len(solr_doc.get("content")) > 0:
+                        yield (solr_doc, django_doc, False), [(doc_id, solr_doc["content"][0], "pdf")]
+                    else:
+                        # download each pdf file, parse with tika, use highest score
+                        contents = []
+                        for pdf_url in solr_doc["pdf_docs"]:
+                            logger.info("Going to parse PDF with url: %s", pdf_url)
+                            contents.append((doc_id, parse_pdf_from_url(pdf_url), "pdf"))
+                        yield (solr_doc, django_doc, True), contents
+                elif solr_doc.get("content"):
+                    # classifier uses base64 content
+                    yield (solr_doc, django_doc, False), [(doc_id, solr_doc["content"][0], "html")]
+                else:
+                    yield (solr_doc, django_doc, False), []
+
+    # the classifier requests run concurrently, the results are stored in the order of the documents
+    scores = []
+    for (solr_doc, django_doc, parsed_pdf_files), classifier_responses in classify_concurrently(classifier_jobs()):
         accepted_probability = CLASSIFIER_ERROR_SCORE
         accepted_probability_index = 0
-        if use_pdf_files and solr_doc.get("pdf_docs"):
-            # download each pdf file, parse with tika, use highest score
-            pdf_urls = solr_doc["pdf_docs"]
-            classifier_responses = []
-            if solr_doc.get("content") and len(solr_doc.get("content")) > 0:
-                content = solr_doc["content"][0]
-                classifier_response = classify(str(solr_doc["id"]), content, "pdf")
-                accepted_probability = classifier_response["accepted_probability"]
-            else:
-                for pdf_url in pdf_urls:
-                    logger.info("Going to parse PDF with url: %s", pdf_url)
-                    content = parse_pdf_from_url(pdf_url)
-                    classifier_responses.append(classify(str(solr_doc["id"]), content, "pdf"))
-                    # Take highest scoring
+        if classifier_responses:
+            # Take highest scoring
+            accepted_probability, accepted_probability_index = max(
+                [(r["accepted_probability"], i) for i, r in enumerate(classifier_responses)]
+            )
+            if parsed_pdf_files:
                 content = classifier_responses[accepted_probability_index]["content"]
-                content_updates.append({"id": solr_doc["id"], "content": {"set": content}})
-                accepted_probability, accepted_probability_index = max(
-                    [(r["accepted_probability"], i) for i, r in enumerate(classifier_responses)]
-                )
-        elif solr_doc.get("content"):
-            # classifier uses base64 content
-            content = solr_doc["content"][0]
-            classifier_response = classify(str(solr_doc["id"]), content, "html")
-            accepted_probability = classifier_response["accepted_probability"]
+                solr_updates.add({"id": solr_doc["id"], "content": {"set": content}})
 
         # Check acceptance
         if accepted_probability != CLASSIFIER_ERROR_SCORE:
@@ -84,90 +261,95 @@ def score_documents(website_name, solr_documents, use_pdf_files):
             classifier_status = AcceptanceStateValue.UNVALIDATED
 
         # Storage
-        django_doc.acceptance_state_max_probability = accepted_probability
-        django_doc.save()
-        score_updates.append(
+        solr_updates.add(
             {
                 "id": solr_doc["id"],
                 "accepted_probability": {"set": accepted_probability},
                 "acceptance_state": {"set": classifier_status},
             }
         )
-        # Store AcceptanceState
-        AcceptanceState.objects.update_or_create(
-            probability_model="auto classifier",
-            document=django_doc,
-            defaults={
-                "value": classifier_status,
-                "accepted_probability": accepted_probability,
-                "accepted_probability_index": accepted_probability_index,
-            },
-        )
-
-        # Store scores (and content) in solr
-        if len(score_updates) == 1000:
-            logger.info("Posting %d scores to SOLR", len(score_updates))
-            client.add(score_updates)
-            score_updates = []
-            requests.get(os.environ["SOLR_URL"] + "/" + core + "/update?commit=true")
-
-        if len(content_updates) == 10:
-            logger.info("Posting %d content to SOLR", len(content_updates))
-            client.add(content_updates)
-            content_updates = []
-            requests.get(os.environ["SOLR_URL"] + "/" + core + "/update?commit=true")
+        scores.append((django_doc, accepted_probability, classifier_status, accepted_probability_index))
+        if len(scores) >= BULK_BATCH_SIZE:
+            save_scores(scores)
+            scores = []
+    save_scores(scores)
 
     # Add unvalidated state for documents without AcceptanceState
     # This can happen when documents didn't have content or couldn't calculate a score
     logger.info("Handling documents without AcceptanceState...")
     website = Website.objects.get(name=website_name)
-    docs = Document.objects.filter(Q(website=website) & Q(acceptance_state_max_probability__isnull=True))
-    for doc in docs:
-        logger.info("CREATE: %s", doc.id)
-        AcceptanceState.objects.update_or_create(
-            probability_model="auto classifier",
-            document=doc,
-            defaults={
-                "value": AcceptanceStateValue.UNVALIDATED,
-                "accepted_probability": DJANGO_ERROR_SCORE,
-                "accepted_probability_index": 0,
-            },
-        )
-        doc.acceptance_state_max_probability = DJANGO_ERROR_SCORE
-        doc.save()
+    docs = Document.objects.filter(Q(website=website) & Q(acceptance_state_max_probability__isnull=True)).only("id")
+    for batch in iter_batches(docs.iterator()):
+        logger.info("CREATE: %d unvalidated states", len(batch))
+        save_scores([(doc, DJANGO_ERROR_SCORE, AcceptanceStateValue.UNVALIDATED, 0) for doc in batch])
 
-    # Flush last updates
-    client.add(score_updates)
-    client.add(content_updates)
-    # Update solr index
+    # Flush last updates and commit the solr index
     logger.info("Committing SOLR index...")
-    core = "documents"
-    requests.get(os.environ["SOLR_URL"] + "/" + core + "/update?commit=true")
+    solr_updates.commit()
+    solr_updates.log_stats()
+    logger.info("Classifier cache: %(hits)d hits, %(misses)d misses", get_classifier_cache_stats())
+    if use_pdf_files:
+        logger.info("PDF text cache: %(hits)d hits, %(misses)d misses, %(errors)d errors", get_pdf_text_stats())
 
 
 def parse_pdf_from_url(url):
-    user_agent_list = [
-        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/13.1.1 Safari/605.1.15",
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:77.0) Gecko/20100101 Firefox/77.0",
-        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36",
-        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:77.0) Gecko/20100101 Firefox/77.0",
-        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36",
-    ]
-    user_agent = random.choice(user_agent_list)
-    headers = {"User-Agent": user_agent}
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        logging.info("PARSE PDF WITH TIKA...")
-        pdf_text = parser.from_buffer(response.content)
-        if pdf_text["content"]:
-            return pdf_text["content"]
-    logging.error(response.text)
-    return ""
+    return extract_pdf_text(url)
+
+
+def get_content_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def get_cached_classification(content_hash, content_type):
+    """Cached accepted probability of a content for the current classifier model, None if not cached."""
+    accepted_probability = (
+        ClassifierResult.objects.filter(
+            content_hash=content_hash, content_type=content_type, model_version=DOCUMENT_CLASSIFIER_VERSION
+        )
+        .values_list("accepted_probability", flat=True)
+        .first()
+    )
+    _classifier_cache_stats["hits" if accepted_probability is not None else "misses"] += 1
+    return accepted_probability
+
+
+def cache_classification(content_hash, content_type, accepted_probability):
+    # failed classifications are tried again next time
+    if accepted_probability == CLASSIFIER_ERROR_SCORE:
+        return
+    bulk_upsert(
+        ClassifierResult,
+        [
+            ClassifierResult(
+                content_hash=content_hash,
+                content_type=content_type,
+                model_version=DOCUMENT_CLASSIFIER_VERSION,
+                accepted_probability=accepted_probability,
+            )
+        ],
+        unique_fields=["content_hash", "content_type", "model_version"],
+        update_fields=["accepted_probability"],
+    )
+
+
+def get_classifier_cache_stats():
+    hits = _classifier_cache_stats["hits"]
+    misses = _classifier_cache_stats["misses"]
+    return {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
 
 
 def classify(django_doc_id, content, content_type):
+    content_hash = get_content_hash(content)
+    accepted_probability = get_cached_classification(content_hash, content_type)
+    if accepted_probability is not None:
+        return {"accepted_probability": accepted_probability, "content": content}
+    js = request_classification(django_doc_id, content, content_type)
+    cache_classification(content_hash, content_type, js["accepted_probability"])
+    return js
+
+
+def request_classification(django_doc_id, content, content_type):
     classifier_url = os.environ["DOCUMENT_CLASSIFIER_URL"] + "/classify_doc"
-    CLASSIFIER_ERROR_SCORE = -9999
     max_content_size_bytes = 50 * 1024 * 1024
     content_bytes = bytes(content, "utf-8")
     # don't classify if content > max_content_size_bytes
@@ -175,10 +357,16 @@ def classify(django_doc_id, content, content_type):
         content_b64 = base64.b64encode(content_bytes).decode("utf-8")
         data = {"content": content_b64, "content_type": content_type}
         logger.debug("Sending content for doc id: " + django_doc_id)
-        response = requests.post(classifier_url, json=data)
-        js = response.json()
+        try:
+            response = get_classifier_session().post(
+                classifier_url, json=data, timeout=(CLASSIFIER_CONNECT_TIMEOUT, CLASSIFIER_TIMEOUT)
+            )
+            js = response.json()
+        except (requests.RequestException, ValueError) as err:
+            logger.error("Classifier request failed for doc id %s: %s", django_doc_id, err)
+            js = {}
         js["content"] = content
-        logger.debug("Got classifier response: " + json.dumps(js))
+        logger.debug("Got classifier response for doc id: " + django_doc_id)
         if "accepted_probability" not in js:
             logger.error("Something went wrong, return ERROR classifier score")
             js = {"accepted_probability": CLASSIFIER_ERROR_SCORE, "content": content}
@@ -187,83 +375,123 @@ def classify(django_doc_id, content, content_type):
     return {"accepted_probability": CLASSIFIER_ERROR_SCORE, "content": content}
 
 
-def load_compressed_cas(file, typesystem):
-    with gzip.open(file, "rb") as f:
-        return load_cas_from_xmi(f, typesystem=typesystem, trusted=True)
+def render_annotations(text, spans):
+    """
+    Insert (start offset, end offset, open tag) spans in text in one pass over the text.
+    Spans are opened outer first, a span that overlaps the end of an enclosing span is closed before it and
+    reopened after it, so the output is always properly nested.
+    """
+    spans = sorted(
+        (span for span in spans if 0 <= span[0] < span[1] <= len(text)),
+        key=lambda span: (span[0], -span[1]),
+    )
+    parts = []
+    stack = []  # open (end, open tag) spans, outer first
+    position = 0
+    i = 0
+    while i < len(spans) or stack:
+        next_start = spans[i][0] if i < len(spans) else len(text)
+        next_end = min(end for end, _ in stack) if stack else len(text)
+        boundary = min(next_start, next_end)
+        parts.append(text[position:boundary])
+        position = boundary
 
+        if stack and next_end == boundary:
+            # close everything down to the outermost span that ends here, reopen the ones that continue
+            outermost = next(index for index, (end, _) in enumerate(stack) if end == boundary)
+            parts.append(SPAN_CLOSE_TAG * (len(stack) - outermost))
+            reopened = [span for span in stack[outermost:] if span[0] > boundary]
+            del stack[outermost:]
+            for span in reopened:
+                parts.append(span[1])
+                stack.append(span)
 
-def enrich_with_annotations(document):
-    minio_client = Minio(
-        os.environ["MINIO_STORAGE_ENDPOINT"],
-        access_key=os.environ["MINIO_ACCESS_KEY"],
-        secret_key=os.environ["MINIO_SECRET_KEY"],
-        secure=False,
+        while i < len(spans) and spans[i][0] == boundary:
+            _, end, open_tag = spans[i]
+            parts.append(open_tag)
+            stack.append((end, open_tag))
+            i += 1
+    parts.append(text[position:])
+    return "".join(parts)
+
+
+def get_annotation_spans(document_id, text):
+    """Spans of the reporting obligations and definitions of a document, with the defined terms in a definition."""
+    spans = []
+    ro_offsets = ReportingObligationOffsets.objects.filter(document=document_id).values_list("start", "end")
+    for start, end in ro_offsets:
+        try:
+            spans.append((int(start), int(end), RO_SPAN_OPEN_TAG))
+        except (TypeError, ValueError):
+            continue
+
+    definitions = ConceptDefined.objects.filter(document=document_id).values_list(
+        "startOffset", "endOffset", "concept__name"
     )
-    bucket_name = "cas-files"
-    try:
-        minio_client.make_bucket(bucket_name)
-    except BucketAlreadyOwnedByYou as err:
-        pass
-    except BucketAlreadyExists as err:
-        pass
+    for start, end, term in definitions:
+        spans.append((start, end, DEFI_SPAN_OPEN_TAG))
+        if not term:
+            continue
+        term_start = text.find(term, start, end)
+        while term_start != -1 and term_start + len(term) <= end:
+            spans.append((term_start, term_start + len(term), TERM_SPAN_OPEN_TAG))
+            term_start = text.find(term, term_start + len(term), end)
+    return spans
 
-    try:
-        object_info = minio_client.stat_object(bucket_name, str(document.id) + ".xml.gz")
-        # skip loading larger than 3MB
-        if object_info.size > 3 * 1000 * 1000:
-            return
-
-        cas_gz = minio_client.get_object(
-            "cas-files",
-            str(document.id) + ".xml.gz",
-        )
-        typesystem = fetch_typesystem()
-        cas = load_compressed_cas(cas_gz, typesystem)
-        sofa_string = cas.get_view("html2textView").sofa_string
-
-        annotations = []
-        ros = ReportingObligationOffsets.objects.filter(document=document).order_by("-endOffset")
-        for ro in ros:
-            annotations.append({"text": ro.ro.name, "startOffset": ro.start, "endOffset": ro.end, "type": "ro"})
-
-        definitions = ConceptDefined.objects.filter(document=document).order_by("-endOffset")
-        for defi in definitions:
-            # if "span" in defi.startOffset:
-            #     continue
-            annotations.append(
-                {
-                    "text": defi.concept.name,
-                    "startOffset": defi.startOffset,
-                    "endOffset": defi.endOffset,
-                    "type": "defi",
-                }
-            )
 
-        content = sofa_string
+def get_annotation_watermark(document_id):
+    """Changes when an annotation of the document is added, removed or edited."""
 
-        for defi in sorted(annotations, key=lambda k: int(k["endOffset"]), reverse=True):
-            term = defi["text"]
-            start_defi = int(defi["startOffset"])
-            end_defi = int(defi["endOffset"])
+    def aggregate(model, document_field, field):
+        rows = model.objects.filter(**{document_field: OuterRef("pk")}).values(document_field)
+        return [
+            Subquery(rows.annotate(value=Count("pk")).values("value")),
+            Subquery(rows.annotate(value=Max(field)).values("value")),
+        ]
 
-            if defi["type"] == "defi":
-                content = content[:end_defi] + SPAN_CLOSE_TAG + content[end_defi:]
-                content = content[:start_defi] + DEFI_SPAN_OPEN_TAG + content[start_defi:]
-                start_defi_after_span = start_defi
-                end_defi_after_span = end_defi + len(SPAN_CLOSE_TAG) + len(DEFI_SPAN_OPEN_TAG)
+    subqueries = (
+        aggregate(ConceptDefined, "document", "pk")
+        + aggregate(ReportingObligationOffsets, "document", "pk")
+        + aggregate(AnnotationWorklog, "document", "updated_at")
+        + aggregate(ROAnnotationWorklog, "ro_offsets__document", "updated_at")
+    )
+    values = (
+        Document.objects.filter(pk=document_id)
+        .annotate(**{"value_%d" % i: subquery for i, subquery in enumerate(subqueries)})
+        .values_list(*["value_%d" % i for i in range(len(subqueries))])
+        .first()
+    )
+    return hashlib.sha1(repr(values).encode("utf-8")).hexdigest()
 
-                defi_string = content[start_defi_after_span:end_defi_after_span]
-                defi_string_pre = defi_string
-                defi_string = defi_string.replace(term, TERM_SPAN_OPEN_TAG + term + SPAN_CLOSE_TAG)
 
-                start = content[:start_defi_after_span]
-                end = content[start_defi_after_span + len(defi_string_pre) :]
-                content = start + defi_string + end
+def get_annotation_cache_key(document_id):
+    return "annotated:{}:{}:{}:{}".format(
+        document_id, EXTRACT_TERMS_NLP_VERSION, EXTRACT_RO_NLP_VERSION, get_annotation_watermark(document_id)
+    )
 
-            elif defi["type"] == "ro":
-                content = content[:end_defi] + SPAN_CLOSE_TAG + content[end_defi:]
-                content = content[:start_defi] + RO_SPAN_OPEN_TAG + content[start_defi:]
 
+def enrich_with_annotations(document):
+    cache = caches[ANNOTATION_CACHE_ALIAS]
+    cache_key = get_annotation_cache_key(document.id)
+    content = cache.get(cache_key)
+    if content is not None:
         return content
-    except NoSuchKey:
-        pass
+
+    minio_client = Minio(
+        os.environ["MINIO_STORAGE_ENDPOINT"],
+        access_key=os.environ["MINIO_ACCESS_KEY"],
+        secret_key=os.environ["MINIO_SECRET_KEY"],
+        secure=False,
+    )
+    try:
+        # skip loading large files
+        cas = get_cas(minio_client, document.id, fetch_typesystem(), max_size=ANNOTATION_MAX_CAS_SIZE)
+    except (NoSuchBucket, NoSuchKey):
+        return
+    if cas is None:
+        return
+    sofa_string = cas.get_view("html2textView").sofa_string
+
+    content = render_annotations(sofa_string, get_annotation_spans(document.id, sofa_string))
+    cache.set(cache_key, content, ANNOTATION_CACHE_TIMEOUT)
+    return content
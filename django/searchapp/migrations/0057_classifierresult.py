@@ -0,0 +1,29 @@
+# Generated by Django 3.0.9 on 2021-05-18 14:03
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('searchapp', '0056_documentsignature'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClassifierResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64)),
+                ('content_type', models.CharField(max_length=20)),
+                ('model_version', models.CharField(max_length=50)),
+                ('accepted_probability', models.FloatField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='classifierresult',
+            constraint=models.UniqueConstraint(fields=('content_hash', 'content_type', 'model_version'), name='unique_per_content_and_model'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.9 on 2021-05-25 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('searchapp', '0057_classifierresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScrapedContentHash',
+            fields=[
+                ('id', models.UUIDField(primary_key=True, serialize=False)),
+                ('content_hash', models.CharField(blank=True, max_length=64)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('website', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='scraped_content_hashes', to='searchapp.Website')),
+            ],
+        ),
+    ]
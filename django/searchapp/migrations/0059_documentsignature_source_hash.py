@@ -0,0 +1,18 @@
+# Generated by Django 3.0.9 on 2021-05-26 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('searchapp', '0058_scrapedcontenthash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentsignature',
+            name='source_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
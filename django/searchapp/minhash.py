@@ -0,0 +1,228 @@
+"""
+MinHash signatures and an LSH banding index for near-duplicate documents.
+
+A signature is computed from the word shingles of the document content when the content is synced and stored
+as MINHASH_NUM_PERM little-endian uint32 values in DocumentSignature. The signature is cut into MINHASH_BANDS
+bands, every band is hashed into a bigint key and the keys are stored in a GIN indexed array. Documents sharing
+a band key are candidates, their Jaccard similarity is estimated by comparing the signatures in one numpy
+operation.
+"""
+import hashlib
+import logging as logger
+import os
+import re
+import zlib
+
+import numpy as np
+from django.db import connection
+
+from searchapp.models import DocumentSignature
+from searchapp.solr_call import solr_search_content_by_id
+
+MINHASH_NUM_PERM = int(os.environ.get("MINHASH_NUM_PERM", 128))
+# rows per band is MINHASH_NUM_PERM / MINHASH_BANDS, 32 bands of 4 rows find pairs from a similarity of about 0.4
+MINHASH_BANDS = int(os.environ.get("MINHASH_BANDS", 32))
+MINHASH_SHINGLE_SIZE = int(os.environ.get("MINHASH_SHINGLE_SIZE", 5))
+MINHASH_THRESHOLD = float(os.environ.get("MINHASH_THRESHOLD", 0.5))
+# Buckets with more documents (eg. boilerplate pages) are skipped, their pairs grow quadratically
+MINHASH_MAX_BUCKET_SIZE = int(os.environ.get("MINHASH_MAX_BUCKET_SIZE", 200))
+MINHASH_CHUNK = 1024
+
+SIGNATURE_DTYPE = np.dtype("<u4")
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+# Fixed seed, signatures have to be comparable between workers and runs
+_PERMUTATIONS = np.random.RandomState(1).randint(1, _MERSENNE_PRIME, size=(2, MINHASH_NUM_PERM), dtype=np.uint64)
+_TOKEN = re.compile(r"\w+")
+
+
+def get_shingles(text, size=MINHASH_SHINGLE_SIZE):
+    tokens = _TOKEN.findall(text.lower())
+    if len(tokens) <= size:
+        return {" ".join(tokens)} if tokens else set()
+    return {" ".join(tokens[i : i + size]) for i in range(len(tokens) - size + 1)}
+
+
+def compute_signature(text):
+    """MinHash signature (numpy uint32 array) of the text, None if the text has no words."""
+    shingles = get_shingles(text)
+    if not shingles:
+        return None
+    hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64)
+    a, b = _PERMUTATIONS
+    signature = np.full(MINHASH_NUM_PERM, _MAX_HASH, dtype=np.uint64)
+    # chunked to bound the (shingles x permutations) matrix for long regulations
+    for start in range(0, len(hashes), MINHASH_CHUNK):
+        chunk = hashes[start : start + MINHASH_CHUNK, np.newaxis]
+        permuted = ((chunk * a + b) % _MERSENNE_PRIME) & _MAX_HASH
+        signature = np.minimum(signature, permuted.min(axis=0))
+    return signature.astype(SIGNATURE_DTYPE)
+
+
+def get_band_keys(signature):
+    rows = len(signature) // MINHASH_BANDS
+    keys = []
+    for band in range(MINHASH_BANDS):
+        digest = hashlib.blake2b(
+            band.to_bytes(2, "big") + signature[band * rows : (band + 1) * rows].tobytes(), digest_size=8
+        ).digest()
+        keys.append(int.from_bytes(digest, "big", signed=True))
+    return keys
+
+
+def load_signatures(values):
+    return np.frombuffer(b"".join(bytes(value) for value in values), dtype=SIGNATURE_DTYPE).reshape(len(values), -1)
+
+
+def get_content_hash(content):
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def update_document_signature(document_id, content, content_hash=None, source_hash=""):
+    """
+    Store the signature of the content of a document, source_hash is the content_hash of the document in Solr.
+    Only the source_hash is stored when content_hash (the stored one if not given) matches the content.
+    Returns True if the signature changed.
+    """
+    new_content_hash = get_content_hash(content)
+    if content_hash is None:
+        content_hash = (
+            DocumentSignature.objects.filter(pk=document_id).values_list("content_hash", flat=True).first()
+        )
+    if content_hash == new_content_hash:
+        if source_hash:
+            DocumentSignature.objects.filter(pk=document_id).exclude(source_hash=source_hash).update(
+                source_hash=source_hash
+            )
+        return False
+
+    signature = compute_signature(content)
+    if signature is None:
+        DocumentSignature.objects.filter(pk=document_id).delete()
+        return False
+    DocumentSignature.objects.update_or_create(
+        document_id=document_id,
+        defaults={
+            "signature": signature.tobytes(),
+            "bands": get_band_keys(signature),
+            "content_hash": new_content_hash,
+            "source_hash": source_hash,
+        },
+    )
+    return True
+
+
+def get_document_signature(document_id):
+    """Stored signature of a document, computed from the Solr content if the document has none yet."""
+    try:
+        return DocumentSignature.objects.get(pk=document_id)
+    except DocumentSignature.DoesNotExist:
+        solr_docs = solr_search_content_by_id("documents", str(document_id))
+        if not solr_docs or "content" not in solr_docs[0]:
+            return None
+        if update_document_signature(document_id, solr_docs[0]["content"][0], content_hash=""):
+            return DocumentSignature.objects.get(pk=document_id)
+        return None
+
+
+def similar_documents(document_id, threshold=0.0, limit=None, cross_website_only=False):
+    """
+    Documents similar to the given document, as (id, title, website, similarity) tuples sorted on the
+    estimated Jaccard similarity, keeping the ones above threshold.
+    """
+    base = get_document_signature(document_id)
+    if base is None:
+        return []
+
+    candidates = DocumentSignature.objects.filter(bands__overlap=base.bands).exclude(pk=base.pk)
+    if cross_website_only:
+        candidates = candidates.exclude(document__website=base.document.website_id)
+    candidates = list(
+        candidates.values_list("document_id", "document__title", "document__website__name", "signature")
+    )
+    base_signature = np.frombuffer(bytes(base.signature), dtype=SIGNATURE_DTYPE)
+    # signatures computed with another MINHASH_NUM_PERM can't be compared
+    candidates = [candidate for candidate in candidates if len(candidate[3]) == len(base.signature)]
+    if not candidates:
+        return []
+
+    similarities = (load_signatures([candidate[3] for candidate in candidates]) == base_signature).mean(axis=1)
+    order = np.argsort(-similarities, kind="stable")
+    results = []
+    for i in order:
+        if similarities[i] <= float(threshold):
+            break
+        document_id, title, website, _ = candidates[i]
+        results.append((str(document_id), title, website.lower(), float(similarities[i])))
+        if limit and len(results) >= int(limit):
+            break
+    return results
+
+
+def near_duplicates(threshold=MINHASH_THRESHOLD, cross_website_only=True):
+    """
+    All pairs of documents sharing an LSH band with an estimated similarity of at least threshold,
+    as (id, id, similarity) tuples sorted on similarity. By default only pairs from different websites.
+    Bands shared by more than MINHASH_MAX_BUCKET_SIZE documents are left out.
+    """
+    with connection.cursor() as cursor:
+        # the ids of the buckets that are too large are not sent, see MINHASH_MAX_BUCKET_SIZE
+        cursor.execute(
+            "SELECT CASE WHEN count(*) <= %s THEN array_agg(document_id) END, count(*) FROM "
+            "(SELECT document_id, unnest(bands) AS band FROM " + DocumentSignature._meta.db_table + ") AS bands "
+            "GROUP BY band HAVING count(*) > 1",
+            [MINHASH_MAX_BUCKET_SIZE],
+        )
+        buckets = []
+        for bucket, size in cursor.fetchall():
+            if bucket is None:
+                logger.warning("Skipped an LSH bucket of %s documents, larger than %s", size, MINHASH_MAX_BUCKET_SIZE)
+            else:
+                buckets.append(bucket)
+
+    pairs = set()
+    for bucket in buckets:
+        bucket = sorted(bucket)
+        for i, first in enumerate(bucket):
+            for second in bucket[i + 1 :]:
+                pairs.add((first, second))
+    if not pairs:
+        return []
+    logger.info("Found %s candidate pairs in %s LSH buckets", len(pairs), len(buckets))
+
+    document_ids = set(document_id for pair in pairs for document_id in pair)
+    rows = DocumentSignature.objects.filter(pk__in=document_ids).values_list(
+        "document_id", "document__website_id", "signature"
+    )
+    index = {}
+    websites = {}
+    values = []
+    for document_id, website_id, signature in rows:
+        if len(signature) != MINHASH_NUM_PERM * SIGNATURE_DTYPE.itemsize:
+            continue
+        index[document_id] = len(values)
+        websites[document_id] = website_id
+        values.append(signature)
+    signatures = load_signatures(values)
+
+    pairs = [
+        (first, second)
+        for first, second in pairs
+        if first in index
+        and second in index
+        and (not cross_website_only or websites[first] != websites[second])
+    ]
+    if not pairs:
+        return []
+    first_rows = signatures[[index[first] for first, _ in pairs]]
+    second_rows = signatures[[index[second] for _, second in pairs]]
+    similarities = (first_rows == second_rows).mean(axis=1)
+
+    duplicates = [
+        (str(first), str(second), float(similarity))
+        for (first, second), similarity in zip(pairs, similarities)
+        if similarity >= threshold
+    ]
+    duplicates.sort(key=lambda x: x[-1], reverse=True)
+    return duplicates
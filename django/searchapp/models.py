@@ -1,14 +1,19 @@
-import os
+import logging
 import uuid
 
 import pysolr
+import requests
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.db.models import Q
 from django.contrib.auth.models import User
 
-from searchapp.solr_call import solr_update
+from searchapp.solr_call import solr_update, get_solr_client
+
+logger = logging.getLogger(__name__)
 
 
 class Website(models.Model):
@@ -64,28 +69,114 @@ class Document(models.Model):
     def __str__(self):
         return self.title
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Document, cls).from_db(db, field_names, values)
+        # remember the loaded values, see get_dirty_fields
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def get_dirty_fields(self):
+        """Names (attname) of the fields that changed since the document was loaded from the database."""
+        fields = [field.attname for field in self._meta.concrete_fields]
+        loaded_values = getattr(self, "_loaded_values", None)
+        if loaded_values is None:
+            return fields
+        return [
+            field
+            for field in fields
+            if field in loaded_values
+            and loaded_values[field] is not models.DEFERRED
+            and getattr(self, field) != loaded_values[field]
+        ]
+
     def update_solr(self):
         solr_doc = {}
-        for field, value in self.__dict__.items():
+        for field in self.get_dirty_fields():
+            value = getattr(self, field)
             if field == "website_id":
                 solr_doc["website"] = self.website.name
             elif field.startswith("date") or field == "created_at" or field == "updated_at":
-                solr_doc[field] = value.strftime("%Y-%m-%dT%H:%M:%SZ")
-            elif not field.startswith("_") and field != "file":
+                solr_doc[field] = value.strftime("%Y-%m-%dT%H:%M:%SZ") if value else None
+            elif field not in ["id", "file"]:
                 solr_doc[field] = value
 
-        # Work around "Object of type UUID is not JSON serializable"
-        solr_doc["id"] = str(solr_doc["id"])
-        # Update solr
-        solr_update("documents", solr_doc)
+        if solr_doc:
+            # Work around "Object of type UUID is not JSON serializable"
+            solr_doc["id"] = str(self.id)
+            # Atomic update of the changed fields only
+            solr_update("documents", solr_doc, atomic=True)
+
+        self._loaded_values = {field.attname: getattr(self, field.attname) for field in self._meta.concrete_fields}
+
+    def update_solr_on_commit(self):
+        """
+        Call update_solr once the current transaction is committed. The database row is already saved,
+        so a Solr error is logged instead of failing the request.
+        """
+
+        def update():
+            try:
+                self.update_solr()
+            except (pysolr.SolrError, requests.exceptions.RequestException) as err:
+                logger.error("Failed to update document %s in Solr: %s", self.id, err)
+
+        transaction.on_commit(update)
 
     def update_score(self, score, status):
         core = "documents"
-        client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
+        client = get_solr_client(core)
         document = {"id": str(self.id), "accepted_probability": {"set": score}, "acceptance_state": {"set": status}}
         client.add(document)
 
 
+class DocumentSignature(models.Model):
+    """MinHash signature of the document content, see searchapp.minhash."""
+
+    document = models.OneToOneField("Document", primary_key=True, related_name="signature", on_delete=models.CASCADE)
+    # uint32 little-endian MinHash values
+    signature = models.BinaryField()
+    # LSH band keys
+    bands = ArrayField(models.BigIntegerField())
+    content_hash = models.CharField(max_length=40)
+    # content_hash of the scraped document in Solr, the content is only fetched again when it changes
+    source_hash = models.CharField(max_length=64, default="", blank=True)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [GinIndex(fields=["bands"], name="searchapp_signature_bands")]
+
+
+class ClassifierResult(models.Model):
+    """Document classifier score of a content, see searchapp.datahandling.classify."""
+
+    content_hash = models.CharField(max_length=64)
+    content_type = models.CharField(max_length=20)
+    model_version = models.CharField(max_length=50)
+    accepted_probability = models.FloatField()
+
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["content_hash", "content_type", "model_version"], name="unique_per_content_and_model"
+            ),
+        ]
+
+
+class ScrapedContentHash(models.Model):
+    """Content hash of the last scraped version of a document in Solr, see scheduler.tasks.sync_scrapy_to_solr_task."""
+
+    # not a foreign key, the document is only created in Django after it was synced to Solr
+    id = models.UUIDField(primary_key=True)
+    website = models.ForeignKey("Website", related_name="scraped_content_hashes", on_delete=models.CASCADE)
+    content_hash = models.CharField(max_length=64, blank=True)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+
 class AcceptanceStateValue(models.TextChoices):
     UNVALIDATED = ("Unvalidated",)
     ACCEPTED = ("Accepted",)
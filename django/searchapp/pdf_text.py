@@ -0,0 +1,230 @@
+"""
+Text extraction of PDF files that are linked from documents.
+
+The PDF is streamed into a spooled temporary file, so only small files stay in memory, and the download is aborted
+when it gets larger than PDF_MAX_SIZE_BYTES. The file is sent to the Tika server of the stack and the extracted
+text is stored in MinIO, content addressed on the URL and ETag of the PDF (the sha256 of the file when the server
+sends no ETag). Extracting the same PDF again is a cache hit: without an ETag it still needs the download, but no
+Tika parse.
+"""
+import hashlib
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from io import BytesIO
+
+import requests
+from minio import Minio, ResponseError
+from minio.error import BucketAlreadyOwnedByYou, BucketAlreadyExists, NoSuchKey
+from urllib3.exceptions import ReadTimeoutError
+
+logger = logging.getLogger(__name__)
+
+PDF_MAX_SIZE_BYTES = int(os.environ.get("PDF_MAX_SIZE_BYTES", 100 * 1000 * 1000))
+# Files up to this size are spooled in memory, larger ones on disk
+PDF_SPOOL_MAX_MEMORY = int(os.environ.get("PDF_SPOOL_MAX_MEMORY", 5 * 1000 * 1000))
+PDF_DOWNLOAD_TIMEOUT = float(os.environ.get("PDF_DOWNLOAD_TIMEOUT", 60))
+PDF_TIKA_TIMEOUT = float(os.environ.get("PDF_TIKA_TIMEOUT", 300))
+PDF_TEXT_BUCKET = os.environ.get("PDF_TEXT_BUCKET", "pdf-text")
+PDF_CHUNK_SIZE = 64 * 1024
+
+USER_AGENTS = [
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/13.1.1 Safari/605.1.15",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:77.0) Gecko/20100101 Firefox/77.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:77.0) Gecko/20100101 Firefox/77.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.97 Safari/537.36",
+]
+
+_session = None
+_minio_client = None
+_lock = threading.Lock()
+_stats = Counter()
+
+
+class PdfTooLarge(Exception):
+    pass
+
+
+class TikaTimeout(Exception):
+    pass
+
+
+def _reset_clients():
+    # connections can't be shared with a forked child
+    global _session, _minio_client
+    _session = None
+    _minio_client = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_clients)
+
+
+def get_tika_url():
+    """Text endpoint of the Tika server, TIKA_SERVER_ENDPOINT may be given with or without the /tika path."""
+    url = os.environ.get("TIKA_SERVER_ENDPOINT", "http://localhost:9998").rstrip("/")
+    if not url.endswith("/tika"):
+        url += "/tika"
+    return url
+
+
+def get_session():
+    """Shared keep-alive session for the PDF downloads and the Tika requests."""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = requests.Session()
+    return _session
+
+
+def get_minio_client():
+    global _minio_client
+    if _minio_client is None:
+        with _lock:
+            if _minio_client is None:
+                minio_client = Minio(
+                    os.environ["MINIO_STORAGE_ENDPOINT"],
+                    access_key=os.environ["MINIO_ACCESS_KEY"],
+                    secret_key=os.environ["MINIO_SECRET_KEY"],
+                    secure=False,
+                )
+                try:
+                    minio_client.make_bucket(PDF_TEXT_BUCKET)
+                except BucketAlreadyOwnedByYou as err:
+                    pass
+                except BucketAlreadyExists as err:
+                    pass
+                _minio_client = minio_client
+    return _minio_client
+
+
+def get_url_cache_key(url, etag):
+    return "url/" + hashlib.sha256((url + "\n" + etag).encode("utf-8")).hexdigest() + ".txt"
+
+
+def get_content_cache_key(content_hash):
+    return "sha256/" + content_hash + ".txt"
+
+
+def get_cached_text(key):
+    """Extracted text stored under key, None if it is not cached or MinIO can't be reached."""
+    try:
+        response = get_minio_client().get_object(PDF_TEXT_BUCKET, key)
+    except NoSuchKey:
+        return None
+    except (ResponseError, requests.exceptions.RequestException, OSError) as err:
+        logger.warning("Failed to read pdf text cache %s: %s", key, err)
+        return None
+    try:
+        return response.data.decode("utf-8")
+    finally:
+        response.release_conn()
+
+
+def cache_text(key, text):
+    data = text.encode("utf-8")
+    try:
+        get_minio_client().put_object(
+            PDF_TEXT_BUCKET, key, BytesIO(data), len(data), content_type="text/plain; charset=utf-8"
+        )
+    except (ResponseError, OSError) as err:
+        logger.warning("Failed to write pdf text cache %s: %s", key, err)
+
+
+def download(response, file):
+    """Stream the body of the response into file, returns the sha256 hex digest of the body."""
+    content_length = response.headers.get("Content-Length")
+    if content_length and content_length.isdigit() and int(content_length) > PDF_MAX_SIZE_BYTES:
+        raise PdfTooLarge(content_length)
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in response.iter_content(PDF_CHUNK_SIZE):
+        size += len(chunk)
+        if size > PDF_MAX_SIZE_BYTES:
+            raise PdfTooLarge(size)
+        digest.update(chunk)
+        file.write(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def parse_with_tika(data, timeout=PDF_TIKA_TIMEOUT):
+    """
+    Plain text of data (bytes or a file), the content type is detected by Tika.
+    Raises TikaTimeout when the text is not received within timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        with get_session().put(
+            get_tika_url(), data=data, headers={"Accept": "text/plain"}, timeout=timeout, stream=True
+        ) as response:
+            response.raise_for_status()
+            chunks = []
+            for chunk in response.iter_content(PDF_CHUNK_SIZE):
+                if time.monotonic() > deadline:
+                    raise TikaTimeout(timeout)
+                chunks.append(chunk)
+    except requests.exceptions.ReadTimeout:
+        raise TikaTimeout(timeout)
+    except requests.exceptions.ConnectionError as err:
+        # a read timeout while the body is streamed
+        if err.args and isinstance(err.args[0], ReadTimeoutError):
+            raise TikaTimeout(timeout)
+        raise
+    return b"".join(chunks).decode("utf-8", errors="replace").strip()
+
+
+def extract_pdf_text(url):
+    """
+    Text of the PDF file at url, from the cache if the same file was extracted before.
+    Returns an empty string when the download or the extraction fails.
+    """
+    session = get_session()
+    headers = {"User-Agent": random.choice(USER_AGENTS)}
+    try:
+        with session.get(url, headers=headers, stream=True, timeout=PDF_DOWNLOAD_TIMEOUT) as response:
+            if response.status_code != 200:
+                logger.error("Failed to download pdf %s: %s", url, response.status_code)
+                return ""
+
+            keys = []
+            etag = response.headers.get("ETag")
+            if etag:
+                keys.append(get_url_cache_key(url, etag))
+                text = get_cached_text(keys[0])
+                if text is not None:
+                    # the body is never read, the connection is closed instead of reused
+                    _stats["hits"] += 1
+                    return text
+
+            with tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_MEMORY) as file:
+                content_key = get_content_cache_key(download(response, file))
+                text = get_cached_text(content_key)
+                if text is not None:
+                    _stats["hits"] += 1
+                else:
+                    _stats["misses"] += 1
+                    logger.info("PARSE PDF WITH TIKA...")
+                    text = parse_with_tika(file)
+                    keys.append(content_key)
+                for key in keys:
+                    cache_text(key, text)
+                return text
+    except PdfTooLarge as err:
+        logger.error("Skipped pdf %s, larger than %s bytes: %s", url, PDF_MAX_SIZE_BYTES, err)
+    except TikaTimeout as err:
+        logger.error("Tika took longer than %s seconds for pdf %s", err, url)
+    except requests.exceptions.RequestException as err:
+        logger.error("Failed to extract text of pdf %s: %s", url, err)
+    _stats["errors"] += 1
+    return ""
+
+
+def get_pdf_text_stats():
+    return {"hits": _stats["hits"], "misses": _stats["misses"], "errors": _stats["errors"]}
@@ -0,0 +1,93 @@
+"""
+Compares response size and latency of the pre-analyzed highlight searches before and after snippet mode.
+
+Run against a (fixture) core that contains pre-analyzed documents, from the django directory:
+
+    SOLR_URL=http://localhost:8983/solr python -m searchapp.scripts.benchmark_preanalyzed_highlighting \
+        --core documents --field concept_occurs --term "competent authority" --rows 10 --runs 20
+"""
+import argparse
+import os
+import statistics
+import time
+
+import requests
+
+from searchapp.solr_call import (
+    QUERY_HL_FL,
+    QUERY_HL_MAX_CHARS,
+    QUERY_HL_POST,
+    QUERY_HL_PRE,
+    QUERY_HL_PREFIX,
+    QUERY_HL_SUFFIX,
+    PREANALYZED_FIELDS,
+    get_preanalyzed_highlight_options,
+)
+
+# Options that were sent by solr_search_query_paginated_preanalyzed before snippet mode
+LEGACY_OPTIONS = {
+    "hl": "on",
+    "fl": "id,title,website,date, content",
+    QUERY_HL_FL: "concept_defined, concept_occurs, ro_highlight",
+    QUERY_HL_MAX_CHARS: "-1",
+    QUERY_HL_PRE: QUERY_HL_PREFIX,
+    QUERY_HL_POST: QUERY_HL_SUFFIX,
+}
+
+
+def benchmark(session, url, options, runs):
+    latencies = []
+    sizes = []
+    num_found = 0
+    for _ in range(runs):
+        start = time.perf_counter()
+        response = session.post(url, data=options)
+        latencies.append((time.perf_counter() - start) * 1000)
+        response.raise_for_status()
+        sizes.append(len(response.content))
+        num_found = response.json()["response"]["numFound"]
+
+    latencies.sort()
+    return {
+        "num_found": num_found,
+        "bytes": int(statistics.mean(sizes)),
+        "mean_ms": statistics.mean(latencies),
+        "p95_ms": latencies[max(0, int(round(0.95 * len(latencies))) - 1)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--solr-url", default=os.environ.get("SOLR_URL", "http://localhost:8983/solr"))
+    parser.add_argument("--core", default="documents")
+    parser.add_argument("--field", default="concept_occurs", choices=PREANALYZED_FIELDS)
+    parser.add_argument("--term", required=True)
+    parser.add_argument("--rows", type=int, default=10)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    url = args.solr_url + "/" + args.core + "/select/"
+    query = "{!term f=" + args.field + "}" + args.term
+    base = {"q": query, "start": 0, "rows": args.rows}
+
+    modes = [
+        ("before", dict(base, **LEGACY_OPTIONS)),
+        ("snippet", dict(base, **get_preanalyzed_highlight_options(query))),
+        ("full_content", dict(base, **get_preanalyzed_highlight_options(query, full_content=True))),
+    ]
+
+    session = requests.Session()
+    print("{:<14}{:>10}{:>14}{:>12}{:>12}".format("mode", "numFound", "bytes", "mean ms", "p95 ms"))
+    for name, options in modes:
+        # Warm up the searcher so every mode is measured on the same caches
+        session.post(url, data=options).raise_for_status()
+        stats = benchmark(session, url, options, args.runs)
+        print(
+            "{:<14}{:>10}{:>14}{:>12.1f}{:>12.1f}".format(
+                name, stats["num_found"], stats["bytes"], stats["mean_ms"], stats["p95_ms"]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
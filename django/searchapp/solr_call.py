@@ -1,33 +1,265 @@
+import copy
+import functools
+import gzip
+import hashlib
+import inspect
+import json
 import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
 
 import pysolr
-import requests
-import textdistance
 import logging as logger
+from django.core.cache import caches
+from requests.adapters import HTTPAdapter
+
+from searchapp.stats import log_stats_periodically
 
 ROW_LIMIT = 250000
 
+# Connection pool defaults, can be overridden per core, eg. SOLR_TIMEOUT_DOCUMENTS=120
+SOLR_TIMEOUT = int(os.environ.get("SOLR_TIMEOUT", 60))
+SOLR_POOL_CONNECTIONS = int(os.environ.get("SOLR_POOL_CONNECTIONS", 4))
+SOLR_POOL_MAXSIZE = int(os.environ.get("SOLR_POOL_MAXSIZE", 10))
+# Page sizes used when walking a result set with cursorMark
+SOLR_CURSOR_ROWS = int(os.environ.get("SOLR_CURSOR_ROWS", 250))
+SOLR_CURSOR_ROWS_IDS = int(os.environ.get("SOLR_CURSOR_ROWS_IDS", 10000))
+# Bulk update thresholds, a buffer is flushed when either limit is reached
+SOLR_UPDATE_MAX_DOCS = int(os.environ.get("SOLR_UPDATE_MAX_DOCS", 1000))
+SOLR_UPDATE_MAX_BYTES = int(os.environ.get("SOLR_UPDATE_MAX_BYTES", 10 * 1024 * 1024))
+SOLR_UPDATE_COMMIT_WITHIN = int(os.environ.get("SOLR_UPDATE_COMMIT_WITHIN", 15000))
+# Only enable when Solr (jetty) is configured to inflate gzipped request bodies
+SOLR_UPDATE_GZIP = os.environ.get("SOLR_UPDATE_GZIP", False) == "True"
+# Search result cache: in-process LRU in front of a shared django cache
+SOLR_CACHE_ENABLED = os.environ.get("SOLR_CACHE_ENABLED", "True") == "True"
+SOLR_CACHE_MAX_ENTRIES = int(os.environ.get("SOLR_CACHE_MAX_ENTRIES", 256))
+SOLR_CACHE_TIMEOUT = int(os.environ.get("SOLR_CACHE_TIMEOUT", 300))
+SOLR_CACHE_ALIAS = os.environ.get("SOLR_CACHE_ALIAS", "default")
+# Seconds an index version is trusted before asking Solr again. The default 0 checks it on every search, so cached
+# results are never stale after a commit. A higher value saves that request but serves the results of the
+# previous index version for up to this long after a commit.
+SOLR_CACHE_VERSION_TTL = float(os.environ.get("SOLR_CACHE_VERSION_TTL", 0))
+# Maximum number of ids in one {!terms f=id} filter, larger id sets are searched per chunk and merged
+SOLR_TERMS_CHUNK_SIZE = int(os.environ.get("SOLR_TERMS_CHUNK_SIZE", 10000))
+# Must match sortMissingLast of the sortable fields in the schema of the documents core. Without it (the Solr
+# default) documents without a value sort as the lowest value: first when ascending, last when descending.
+SOLR_SORT_MISSING_LAST = os.environ.get("SOLR_SORT_MISSING_LAST", "False") == "True"
+SOLR_CONTENT_HEAD_CHARS = int(os.environ.get("SOLR_CONTENT_HEAD_CHARS", 10000))
+# Snippet mode highlighting, used by the list views
+SOLR_HL_FRAGSIZE = int(os.environ.get("SOLR_HL_FRAGSIZE", 100))
+SOLR_HL_SNIPPETS = int(os.environ.get("SOLR_HL_SNIPPETS", 3))
+SOLR_HL_MAX_ANALYZED_CHARS = int(os.environ.get("SOLR_HL_MAX_ANALYZED_CHARS", 1000000))
+SOLR_SYNC_FIELDS = "id,custom_id,title,title_prefix,author,misc_author,status,type,date,dates,dates_type,dates_info,date_last_update,url,eli,celex,file_url,website,summary,various,consolidated_versions"
+
 QUERY_ID_ASC = "id asc"
 QUERY_HL_FL = "hl.fl"
 QUERY_HL_SNIPPETS = "hl.snippets"
 QUERY_HL_MAX_CHARS = "hl.maxAnalyzedChars"
 QUERY_HL_PRE = "hl.simple.pre"
 QUERY_HL_POST = "hl.simple.post"
+QUERY_HL_FRAGSIZE = "hl.fragsize"
 QUERY_HL_PREFIX = '<span class="highlight">'
 QUERY_HL_SUFFIX = "</span>"
 
+PREANALYZED_FIELDS = ["concept_occurs", "concept_defined", "ro_highlight"]
+# Fields rendered by the Angular list views, the full content is only sent in full content mode
+PREANALYZED_SNIPPET_FL = "id,title,website,date"
+PREANALYZED_FULL_CONTENT_FL = "id,title,website,date,content"
+PREANALYZED_TERM_QUERY = re.compile(r"^\{!term f=(\w+)\}")
+
+_solr_clients = {}
+_solr_clients_lock = threading.Lock()
+
+
+def _core_setting(name, core, default):
+    return int(os.environ.get(name + "_" + core.upper(), default))
+
+
+def _reset_solr_clients():
+    # Sessions (and their sockets) must not be shared between forked processes
+    # (celery prefork, gunicorn workers), every child builds its own registry.
+    global _solr_clients_lock
+    _solr_clients.clear()
+    _solr_clients_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_solr_clients)
+
+
+def get_solr_client(core):
+    """
+    Return the process wide pysolr client for a core. The client keeps a
+    keep-alive session with a connection pool, so consecutive calls reuse the
+    same TCP connections instead of opening a new one per request.
+    """
+    log_stats_periodically("Solr connection pool", get_solr_client_stats)
+    client = _solr_clients.get(core)
+    if client is not None:
+        return client
+
+    with _solr_clients_lock:
+        client = _solr_clients.get(core)
+        if client is None:
+            pool_maxsize = _core_setting("SOLR_POOL_MAXSIZE", core, SOLR_POOL_MAXSIZE)
+            adapter = HTTPAdapter(
+                pool_connections=_core_setting("SOLR_POOL_CONNECTIONS", core, SOLR_POOL_CONNECTIONS),
+                pool_maxsize=pool_maxsize,
+            )
+            client = pysolr.Solr(
+                os.environ["SOLR_URL"] + "/" + core, timeout=_core_setting("SOLR_TIMEOUT", core, SOLR_TIMEOUT)
+            )
+            session = client.get_session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _solr_clients[core] = client
+    return client
+
+
+def get_solr_client_stats():
+    """
+    Connection pool counters of the Solr clients of this process per core. A request sent over a pooled keep-alive
+    connection is a hit, a request that had to open a new connection is a miss.
+    """
+    stats = {}
+    for core, client in list(_solr_clients.items()):
+        pools = client.get_session().get_adapter(client.url).poolmanager.pools
+        requests_sent = connections = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests_sent += pool.num_requests
+                connections += pool.num_connections
+        stats[core] = {"hits": max(requests_sent - connections, 0), "misses": connections}
+    return stats
+
+
+_search_cache = OrderedDict()
+_search_cache_lock = threading.Lock()
+_search_cache_stats = Counter()
+_index_versions = {}
+
+
+def get_index_version(core):
+    """
+    Version of the searcher currently open on a core, it changes with every
+    commit that opens a new searcher. Returns None when Solr can't tell.
+    """
+    now = time.time()
+    with _search_cache_lock:
+        cached = _index_versions.get(core)
+    if cached and now - cached[1] < SOLR_CACHE_VERSION_TTL:
+        return cached[0]
+
+    client = get_solr_client(core)
+    try:
+        response = client.get_session().get(
+            client.url + "/admin/luke",
+            params={"show": "index", "numTerms": 0, "wt": "json"},
+            timeout=client.timeout,
+        )
+        index = response.json()["index"]
+        version = str(index["version"])
+    except (ValueError, KeyError, IOError) as err:
+        logger.warning("Could not read index version of core %s: %s", core, err)
+        return None
+    with _search_cache_lock:
+        _index_versions[core] = (version, now)
+    return version
+
+
+def forget_index_version(core):
+    """Ask Solr for the index version of a core on the next search, called after a commit from this process."""
+    with _search_cache_lock:
+        _index_versions.pop(core, None)
+
+
+def _normalize_search_param(name, value):
+    if isinstance(value, str):
+        value = value.strip()
+        if name in ["page_number", "rows_per_page"] and value.isdigit():
+            return int(value)
+    if isinstance(value, (list, tuple)):
+        return sorted(value)
+    return value
+
+
+def solr_cached(func):
+    """
+    Cache the result of a search function for identical (normalized) queries.
+    The key contains the index version of the core, so a commit invalidates
+    every cached page of that core. The arguments must be JSON serializable.
+    Every caller gets its own copy of the result, so it may be modified.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        log_stats_periodically("Solr search cache", get_solr_cache_stats)
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        core = bound.arguments.get("core", "")
+        version = get_index_version(core) if SOLR_CACHE_ENABLED else None
+        if version is None:
+            return func(*args, **kwargs)
+
+        params = {name: _normalize_search_param(name, value) for name, value in bound.arguments.items()}
+        raw_key = json.dumps([func.__name__, core, version, params], sort_keys=True, default=str)
+        key = "solr_search:" + hashlib.sha1(raw_key.encode("utf-8")).hexdigest()
+
+        with _search_cache_lock:
+            if key in _search_cache:
+                _search_cache.move_to_end(key)
+                _search_cache_stats["local_hits"] += 1
+                cached = _search_cache[key]
+            else:
+                cached = None
+        if cached is not None:
+            return copy.deepcopy(cached)
+
+        shared_cache = caches[SOLR_CACHE_ALIAS]
+        result = shared_cache.get(key)
+        if result is not None:
+            _search_cache_stats["shared_hits"] += 1
+        else:
+            _search_cache_stats["misses"] += 1
+            result = func(*args, **kwargs)
+            shared_cache.set(key, result, SOLR_CACHE_TIMEOUT)
+
+        with _search_cache_lock:
+            _search_cache[key] = copy.deepcopy(result)
+            while len(_search_cache) > SOLR_CACHE_MAX_ENTRIES:
+                _search_cache.popitem(last=False)
+        return result
+
+    return wrapper
+
+
+def get_solr_cache_stats():
+    hits = _search_cache_stats["local_hits"] + _search_cache_stats["shared_hits"]
+    total = hits + _search_cache_stats["misses"]
+    return {
+        "local_hits": _search_cache_stats["local_hits"],
+        "shared_hits": _search_cache_stats["shared_hits"],
+        "misses": _search_cache_stats["misses"],
+        "hit_rate": hits / total if total else 0.0,
+        "entries": len(_search_cache),
+    }
+
 
-def solr_search(core="", term=""):
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
+def solr_search(core="", term="", rows=10):
+    client = get_solr_client(core)
     search = get_results_highlighted(
         client.search(
             term,
             **{
-                "rows": ROW_LIMIT,
+                "rows": rows,
                 "hl": "on",
                 QUERY_HL_FL: "*",
-                QUERY_HL_SNIPPETS: 100,
-                QUERY_HL_MAX_CHARS: 1000000,
+                QUERY_HL_FRAGSIZE: SOLR_HL_FRAGSIZE,
+                QUERY_HL_SNIPPETS: SOLR_HL_SNIPPETS,
+                QUERY_HL_MAX_CHARS: SOLR_HL_MAX_ANALYZED_CHARS,
                 QUERY_HL_PRE: QUERY_HL_PREFIX,
                 QUERY_HL_POST: QUERY_HL_SUFFIX,
             }
@@ -36,14 +268,53 @@ def solr_search(core="", term=""):
     return search
 
 
+def get_preanalyzed_highlight_options(term="", field=None, full_content=False):
+    """
+    Highlighting options for a query on the pre-analyzed fields.
+
+    Every pre-analyzed field embeds the whole document text. In snippet mode (the default) only the queried
+    field is highlighted, with at most SOLR_HL_SNIPPETS fragments of SOLR_HL_FRAGSIZE characters per document,
+    and the content field is not returned. With full_content the complete highlighted fields and the content are
+    returned, which is what the document detail pages render.
+    """
+    if field is None:
+        match = PREANALYZED_TERM_QUERY.match(term)
+        if match and match.group(1) in PREANALYZED_FIELDS:
+            field = match.group(1)
+    options = {
+        "hl": "on",
+        QUERY_HL_FL: field if field else ",".join(PREANALYZED_FIELDS),
+        QUERY_HL_PRE: QUERY_HL_PREFIX,
+        QUERY_HL_POST: QUERY_HL_SUFFIX,
+    }
+    if full_content:
+        options.update(
+            {
+                "fl": PREANALYZED_FULL_CONTENT_FL,
+                QUERY_HL_FRAGSIZE: 0,
+                QUERY_HL_MAX_CHARS: -1,
+            }
+        )
+    else:
+        options.update(
+            {
+                "fl": PREANALYZED_SNIPPET_FL,
+                "hl.requireFieldMatch": "true",
+                QUERY_HL_FRAGSIZE: SOLR_HL_FRAGSIZE,
+                QUERY_HL_SNIPPETS: SOLR_HL_SNIPPETS,
+                QUERY_HL_MAX_CHARS: SOLR_HL_MAX_ANALYZED_CHARS,
+            }
+        )
+    return options
+
+
 def solr_search_ids(core="", term=""):
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    search = client.search(term, **{"rows": ROW_LIMIT, "fl": "id"})
-    return search
+    return solr_iterate(core, term, fl="id", rows=SOLR_CURSOR_ROWS_IDS)
 
 
+@solr_cached
 def solr_search_website_paginated(core="", q="", page_number=1, rows_per_page=10):
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
+    client = get_solr_client(core)
     # solr page starts at 0
     page_number = int(page_number) - 1
     start = page_number * int(rows_per_page)
@@ -51,18 +322,77 @@ def solr_search_website_paginated(core="", q="", page_number=1, rows_per_page=10
     return client.search(q, **options)
 
 
+def get_id_filters(ids, chunk_size=SOLR_TERMS_CHUNK_SIZE):
+    """
+    Filter queries restricting a search to the given document ids, one {!terms f=id} filter per chunk of ids.
+    The terms query parser is not bound to maxBooleanClauses. The ids are sorted, so the same set of ids always
+    gives the same filter, which Solr keeps in its filterCache for the next pages.
+    """
+    ids = sorted(set(ids))
+    return ["{!terms f=id cache=true}" + ",".join(ids[i : i + chunk_size]) for i in range(0, len(ids), chunk_size)]
+
+
+def _merge_key(doc, sort_by):
+    value = doc.get(sort_by) if sort_by else doc.get("score")
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return value
+
+
+def solr_search_highlighted(
+    client, term, options, ids_to_filter_on=None, start=0, rows=10, sort_by=None, sort_direction="asc"
+):
+    """
+    Search with highlighting, optionally restricted to a set of ids. Returns the number of documents found and
+    the highlighted page. The search is sent as a POST request when the parameters don't fit in a URL.
+
+    When the ids don't fit in a single filter, every chunk is searched for its first start + rows documents and
+    the results are merged on the sort field (the score if not sorted) before the page is cut out.
+    """
+    if sort_by:
+        options["sort"] = sort_by + " " + sort_direction
+    id_filters = get_id_filters(ids_to_filter_on) if ids_to_filter_on else []
+
+    if len(id_filters) <= 1:
+        if id_filters:
+            options["fq"] = id_filters[0]
+        result = client.search(term, start=start, rows=rows, **options)
+        return result.raw_response["response"]["numFound"], get_results_highlighted(result)
+
+    if not sort_by:
+        options["fl"] = "*,score"
+    num_found = 0
+    keyed_docs = []
+    for id_filter in id_filters:
+        result = client.search(term, fq=id_filter, start=0, rows=start + rows, **options)
+        num_found += result.raw_response["response"]["numFound"]
+        # the sort values are read before the highlighting replaces them
+        keys = [_merge_key(doc, sort_by) for doc in result.docs]
+        keyed_docs.extend(zip(keys, get_results_highlighted(result)))
+
+    descending = sort_direction == "desc" if sort_by else True
+    sorted_docs = sorted((x for x in keyed_docs if x[0] is not None), key=lambda x: x[0], reverse=descending)
+    docs = [doc for key, doc in sorted_docs]
+    missing = [doc for key, doc in keyed_docs if key is None]
+    # documents without a value for the sort field are placed like Solr does, see SOLR_SORT_MISSING_LAST
+    if SOLR_SORT_MISSING_LAST or descending:
+        docs.extend(missing)
+    else:
+        docs = missing + docs
+    return num_found, docs[start : start + rows]
+
+
+@solr_cached
 def solr_search_paginated(
     core="", term="", page_number=1, rows_per_page=10, ids_to_filter_on=None, sort_by=None, sort_direction="asc"
 ):
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
+    client = get_solr_client(core)
     # solr page starts at 0
     page_number = int(page_number) - 1
     start = page_number * int(rows_per_page)
     if core == "documents":
         term = "content:" + '"' + term + '"'
     options = {
-        "rows": rows_per_page,
-        "start": start,
         "hl": "on",
         QUERY_HL_FL: "*",
         "hl.requireFieldMatch": "true",
@@ -71,27 +401,19 @@ def solr_search_paginated(
         QUERY_HL_PRE: QUERY_HL_PREFIX,
         QUERY_HL_POST: QUERY_HL_SUFFIX,
     }
-    if ids_to_filter_on:
-        fq_ids = "id:(" + " OR ".join(ids_to_filter_on) + ")"
-        options["fq"] = fq_ids
-    if sort_by:
-        options["sort"] = sort_by + " " + sort_direction
-    result = client.search(term, **options)
-    search = get_results_highlighted(result)
-    num_found = result.raw_response["response"]["numFound"]
-    return num_found, search
+    return solr_search_highlighted(
+        client, term, options, ids_to_filter_on, start, int(rows_per_page), sort_by, sort_direction
+    )
 
 
 def solr_search_query_paginated(
     core="", term="", page_number=1, rows_per_page=10, ids_to_filter_on=None, sort_by=None, sort_direction="asc"
 ):
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
+    client = get_solr_client(core)
     # solr page starts at 0
     page_number = int(page_number) - 1
     start = page_number * int(rows_per_page)
     options = {
-        "rows": rows_per_page,
-        "start": start,
         "hl": "on",
         QUERY_HL_FL: "*",
         "hl.requireFieldMatch": "true",
@@ -100,48 +422,14 @@ def solr_search_query_paginated(
         QUERY_HL_PRE: QUERY_HL_PREFIX,
         QUERY_HL_POST: QUERY_HL_SUFFIX,
     }
-    if ids_to_filter_on:
-        fq_ids = "id:(" + " OR ".join(ids_to_filter_on) + ")"
-        options["fq"] = fq_ids
-    if sort_by:
-        options["sort"] = sort_by + " " + sort_direction
-    result = client.search(term, **options)
-    search = get_results_highlighted(result)
-    num_found = result.raw_response["response"]["numFound"]
-    return num_found, search
-
-
-def solr_search_query_paginated_preanalyzed(
-    core="", term="", page_number=1, rows_per_page=10, sort_by=None, sort_direction="asc"
-):
-    url = os.environ["SOLR_URL"] + "/" + core + "/select/"
-    # solr page starts at 0
-    page_number = int(page_number) - 1
-    start = page_number * int(rows_per_page)
-    options = {
-        "q": term,
-        "hl": "on",
-        "fl": "id,title,website,date, content",
-        QUERY_HL_FL: "concept_defined, concept_occurs",
-        QUERY_HL_MAX_CHARS: "-1",
-        QUERY_HL_PRE: QUERY_HL_PREFIX,
-        QUERY_HL_POST: QUERY_HL_SUFFIX,
-        "start": start,
-        "rows": rows_per_page,
-    }
-
-    if sort_by:
-        options["sort"] = sort_by + " " + sort_direction
-    response = requests.request("POST", url, data=options)
-    result = response.json()
-    search = get_results_highlighted_preanalyzed(result)
-    num_found = result["response"]["numFound"]
-
-    return num_found, search
+    return solr_search_highlighted(
+        client, term, options, ids_to_filter_on, start, int(rows_per_page), sort_by, sort_direction
+    )
 
 
+@solr_cached
 def solr_search_query_paginated_preanalyzed(
-    core="", term="", page_number=1, rows_per_page=10, sort_by=None, sort_direction="asc"
+    core="", term="", page_number=1, rows_per_page=10, sort_by=None, sort_direction="asc", full_content=False
 ):
     url = os.environ["SOLR_URL"] + "/" + core + "/select/"
     # solr page starts at 0
@@ -149,19 +437,15 @@ def solr_search_query_paginated_preanalyzed(
     start = page_number * int(rows_per_page)
     options = {
         "q": term,
-        "hl": "on",
-        "fl": "id,title,website,date, content",
-        QUERY_HL_FL: "concept_defined, concept_occurs, ro_highlight",
-        QUERY_HL_MAX_CHARS: "-1",
-        QUERY_HL_PRE: QUERY_HL_PREFIX,
-        QUERY_HL_POST: QUERY_HL_SUFFIX,
         "start": start,
         "rows": rows_per_page,
     }
+    options.update(get_preanalyzed_highlight_options(term, full_content=full_content))
 
     if sort_by:
         options["sort"] = sort_by + " " + sort_direction
-    response = requests.request("POST", url, data=options)
+    client = get_solr_client(core)
+    response = client.get_session().post(url, data=options, timeout=client.timeout)
     result = response.json()
     search = get_results_highlighted_preanalyzed(result)
     num_found = result["response"]["numFound"]
@@ -170,7 +454,14 @@ def solr_search_query_paginated_preanalyzed(
 
 
 def solr_search_query_with_doc_id_preanalyzed(
-    doc_id, core="", term="", page_number=1, rows_per_page=10, sort_by=None, sort_direction="asc"
+    doc_id,
+    core="",
+    term="",
+    page_number=1,
+    rows_per_page=10,
+    sort_by=None,
+    sort_direction="asc",
+    full_content=False,
 ):
     url = os.environ["SOLR_URL"] + "/" + core + "/select/"
     # solr page starts at 0
@@ -178,120 +469,141 @@ def solr_search_query_with_doc_id_preanalyzed(
     start = page_number * int(rows_per_page)
     options = {
         "q": term,
-        "hl": "on",
-        "hl.fragsize": "0",
-        "fl": "id,title,website,date,content",
-        QUERY_HL_FL: "concept_defined, concept_occurs, ro_highlight",
-        QUERY_HL_MAX_CHARS: "-1",
-        QUERY_HL_PRE: QUERY_HL_PREFIX,
-        QUERY_HL_POST: QUERY_HL_SUFFIX,
         "start": start,
         "rows": rows_per_page,
     }
+    options.update(get_preanalyzed_highlight_options(term, full_content=full_content))
     if doc_id:
         options["fq"] = "id:" + doc_id
 
     if sort_by:
         options["sort"] = sort_by + " " + sort_direction
 
-    response = requests.request("POST", url, data=options)
+    client = get_solr_client(core)
+    response = client.get_session().post(url, data=options, timeout=client.timeout)
     result = response.json()
     num_found = result["response"]["numFound"]
 
     return num_found, result
 
 
-def solr_get_preanalyzed_for_doc(
-    core="", id="", field="", term="", page_number=1, rows_per_page=10, sort_by=None, sort_direction="asc"
-):
-
-    query = "{!term f=" + field + "}" + term
+def solr_get_preanalyzed_for_docs(core="", ids=None, field="", term=""):
+    """
+    First highlighted fragment of a pre-analyzed field for each of the given document ids, in one request.
+    Returns a dict from document id to fragment, documents without highlighting are left out.
+    """
+    ids = [str(id) for id in ids or []]
+    if not ids:
+        return {}
 
     url = os.environ["SOLR_URL"] + "/" + core + "/select/"
-    # solr page starts at 0
-    page_number = int(page_number) - 1
-    start = page_number * int(rows_per_page)
     options = {
-        "q": query,
-        "id": id,
-        "hl": "on",
-        "fl": "id,title,website,date",
-        QUERY_HL_FL: field,
-        QUERY_HL_MAX_CHARS: "-1",
-        QUERY_HL_PRE: QUERY_HL_PREFIX,
-        QUERY_HL_POST: QUERY_HL_SUFFIX,
-        "start": start,
-        "rows": rows_per_page,
+        "q": "{!term f=" + field + "}" + term,
+        "fq": get_id_filters(ids, chunk_size=len(ids))[0],
+        "start": 0,
+        "rows": len(ids),
     }
+    options.update(get_preanalyzed_highlight_options(field=field))
+    options["fl"] = "id"
+    # Only the first fragment is shown, but it may be anywhere in the document
+    options[QUERY_HL_SNIPPETS] = 1
+    options[QUERY_HL_MAX_CHARS] = -1
 
-    if sort_by:
-        options["sort"] = sort_by + " " + sort_direction
-    response = requests.request("POST", url, data=options)
-    fields = ["concept_occurs", "concept_defined", "ro_highlight"]
+    client = get_solr_client(core)
+    response = client.get_session().post(url, data=options, timeout=client.timeout)
 
-    highlights = []
+    highlights = {}
     if response.status_code == 200:
-        result = response.json()
-        for doc in result["response"]["docs"]:
-            for document_field in fields:
-                if document_field in result["highlighting"][doc["id"]]:
-                    doc[document_field] = result["highlighting"][doc["id"]][document_field]
-                    # Specific only the highlights
-                    highlights.append(result["highlighting"][doc["id"]][document_field])
-
-    if len(highlights) > 0:
-        return highlights[0][0]
+        for doc_id, doc_highlighting in response.json().get("highlighting", {}).items():
+            if doc_highlighting.get(field):
+                highlights[doc_id] = doc_highlighting[field][0]
     else:
-        return None
+        logger.error("Highlighting %s failed: %s", field, response.text)
+
+    return highlights
+
+
+def solr_iterate(core, q, fl=None, rows=SOLR_CURSOR_ROWS, **kwargs):
+    """
+    Lazily yield every document matching ``q`` by deep paging with cursorMark.
+    Only one page of ``rows`` documents is held in memory at a time, use ``fl``
+    to project the fields that are needed. Extra kwargs are passed to Solr (eg. fq).
+    """
+    for result in solr_iterate_pages(core, q, fl=fl, rows=rows, **kwargs):
+        yield from result.docs
+
+
+def solr_iterate_pages(core, q, fl=None, rows=SOLR_CURSOR_ROWS, **kwargs):
+    """Same as ``solr_iterate``, but yields the pysolr result of every page (eg. to read the highlighting)."""
+    client = get_solr_client(core)
+    options = {"rows": rows, "sort": QUERY_ID_ASC, "cursorMark": "*"}
+    if fl:
+        options["fl"] = fl
+    options.update(kwargs)
+    while True:
+        result = client.search(q, **options)
+        yield result
+        # cursor is exhausted when Solr returns the same cursorMark we sent
+        if result.nextCursorMark is None or result.nextCursorMark == options["cursorMark"]:
+            break
+        options["cursorMark"] = result.nextCursorMark
 
 
 def solr_search_id(core="", id=""):
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    search = get_results(client.search("id:" + id, **{"rows": ROW_LIMIT}))
-    return search
+    return list(solr_iterate(core, "id:" + id))
 
 
 def solr_search_content_by_id(core="", id=""):
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    search = get_results(client.search("id:" + id, **{"rows": ROW_LIMIT, "fl": "content"}))
-    return search
+    return list(solr_iterate(core, "id:" + id, fl="content"))
 
 
 def solr_search_id_sorted(core="", id=""):
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    search = get_results(client.search("id:" + id, **{"rows": ROW_LIMIT, "sort": QUERY_ID_ASC}))
-    return search
+    return list(solr_iterate(core, "id:" + id))
 
 
-def solr_search_website_with_content(core="", website="", **kwargs):
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
+def solr_search_website_with_content(core="", website="", fl=None, **kwargs):
     date = kwargs.get("date", None)
     query = "website:" + website
 
     if date:
         query = query + " AND date:[" + date + " TO NOW]"
-    search = client.search(query, **{"rows": 250, "start": 0, "cursorMark": "*", "sort": QUERY_ID_ASC})
-    return search
+    return solr_iterate(core, query, fl=fl)
 
 
-def solr_search_website_sorted(core="", website="", **kwargs):
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    SOLR_SYNC_FIELDS = "id,custom_id,title,title_prefix,author,misc_author,status,type,date,dates,dates_type,dates_info,date_last_update,url,eli,celex,file_url,website,summary,various,consolidated_versions"
+def solr_search_website_content_head(core="", website="", size=SOLR_CONTENT_HEAD_CHARS, fl="id"):
+    """
+    Documents of a website with only the first ``size`` characters of their content, documents without content are
+    left out. The content field doesn't match the query, so the original highlighter returns the alternate field
+    cut at hl.maxAlternateFieldLength instead of a fragment and the full content is never sent.
+    """
+    options = {
+        "hl": "true",
+        "hl.method": "original",
+        QUERY_HL_FL: "content",
+        "hl.requireFieldMatch": "true",
+        "hl.alternateField": "content",
+        "hl.maxAlternateFieldLength": size,
+        QUERY_HL_MAX_CHARS: size,
+    }
+    for result in solr_iterate_pages(core, "website:" + website, fl=fl, **options):
+        for doc in result.docs:
+            content = result.highlighting.get(doc["id"], {}).get("content")
+            if content:
+                doc["content"] = content
+                yield doc
+
+
+def solr_search_website_sorted(core="", website="", fl=SOLR_SYNC_FIELDS, **kwargs):
     date = kwargs.get("date", None)
     query = "website:" + website
 
     if date:
         query = query + " AND date:[" + date + " TO NOW]"
-    search = get_results(client.search(query, **{"rows": ROW_LIMIT, "fl": SOLR_SYNC_FIELDS, "sort": QUERY_ID_ASC}))
-    return search
+    return solr_iterate(core, query, fl=fl)
 
 
 def solr_search_document_id_sorted(core="", document_id=""):
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    search = get_results(
-        client.search('attr_document_id:"' + document_id + '"', **{"rows": ROW_LIMIT, "sort": QUERY_ID_ASC})
-    )
-    return search
+    return solr_iterate(core, 'attr_document_id:"' + document_id + '"')
 
 
 def get_results(response):
@@ -315,12 +627,11 @@ def get_results_highlighted(response):
 
 def get_results_highlighted_preanalyzed(response):
     results = []
-    fields = ["concept_occurs", "concept_defined", "ro_highlight"]
 
     highlights = []
     # iterate over docs
     for doc in response["response"]["docs"]:
-        for document_field in fields:
+        for document_field in PREANALYZED_FIELDS:
             # iterate over every key in single doc dictionary
             # Here we replace the docs['concept_defined'] full-text by the one provided by the highlighting (shorter)
             if document_field in response["highlighting"][doc["id"]]:
@@ -332,23 +643,162 @@ def get_results_highlighted_preanalyzed(response):
     return results
 
 
-def solr_update(core, document):
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    document_existing_result = client.search("id:" + str(document["id"]))
-    if len(document_existing_result.docs) == 1:
-        document_existing = document_existing_result.docs[0]
-        for key, value in document.items():
-            if key == "file_url":
-                document_existing[key] = value.name
-            elif key != "id":
-                document_existing[key] = value
-        client.add([document_existing], commit=True)
+class SolrUpdateBuffer:
+    """
+    Collects (atomic) update documents for a core and posts them in bulk.
+
+    The buffer is flushed when it holds ``max_docs`` documents or ``max_bytes``
+    of JSON. Flushed batches become visible through ``commitWithin``, a single
+    hard commit is sent by ``commit()``, which is called when the buffer is used
+    as a context manager:
+
+        with SolrUpdateBuffer("documents", name="score") as buffer:
+            buffer.add({"id": doc_id, "accepted_probability": {"set": score}})
+    """
+
+    def __init__(
+        self,
+        core,
+        name=None,
+        max_docs=SOLR_UPDATE_MAX_DOCS,
+        max_bytes=SOLR_UPDATE_MAX_BYTES,
+        commit_within=SOLR_UPDATE_COMMIT_WITHIN,
+        use_gzip=SOLR_UPDATE_GZIP,
+    ):
+        self.core = core
+        self.name = name or core
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.commit_within = commit_within
+        self.use_gzip = use_gzip
+        self.client = get_solr_client(core)
+        self._pending = []
+        self._pending_bytes = 0
+        self.documents = 0
+        self.bytes = 0
+        self.bytes_sent = 0
+        self.requests = 0
+        self.started = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            # the job failed: drop the pending batch, but commit what was already flushed
+            self.discard()
+            try:
+                self.commit()
+            except pysolr.SolrError as err:
+                logger.error("[%s] Could not commit Solr updates: %s", self.name, err)
+        self.log_stats()
+        return False
+
+    def add(self, document):
+        encoded = json.dumps(document).encode("utf-8")
+        self._pending.append(encoded)
+        self._pending_bytes += len(encoded)
+        if len(self._pending) >= self.max_docs or self._pending_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        payload = b"[" + b",".join(self._pending) + b"]"
+        headers = {"Content-type": "application/json; charset=utf-8"}
+        body = payload
+        if self.use_gzip:
+            body = gzip.compress(payload)
+            headers["Content-Encoding"] = "gzip"
+        params = {"commitWithin": self.commit_within} if self.commit_within else {}
+        self._post(body, headers, params)
+
+        logger.info("[%s] Posted %d documents (%d bytes) to Solr", self.name, len(self._pending), len(payload))
+        self.documents += len(self._pending)
+        self.bytes += len(payload)
+        self.bytes_sent += len(body)
+        self.discard()
+
+    def discard(self):
+        self._pending = []
+        self._pending_bytes = 0
+
+    def commit(self):
+        self.flush()
+        self._post(None, {}, {"commit": "true"})
+        forget_index_version(self.core)
+
+    def _post(self, body, headers, params):
+        response = self.client.get_session().post(
+            self.client.url + "/update", data=body, headers=headers, params=params, timeout=self.client.timeout
+        )
+        self.requests += 1
+        if response.status_code != 200:
+            raise pysolr.SolrError(
+                "Solr responded with an error (HTTP %s): %s" % (response.status_code, response.text[:500])
+            )
+
+    def stats(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        return {
+            "documents": self.documents,
+            "bytes": self.bytes,
+            "bytes_sent": self.bytes_sent,
+            "requests": self.requests,
+            "seconds": elapsed,
+            "documents_per_second": self.documents / elapsed,
+            "bytes_per_second": self.bytes / elapsed,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info(
+            "[%s] Solr updates: %d documents, %d bytes in %.1fs (%.1f docs/s, %.1f bytes/s, %d requests)",
+            self.name,
+            stats["documents"],
+            stats["bytes"],
+            stats["seconds"],
+            stats["documents_per_second"],
+            stats["bytes_per_second"],
+            stats["requests"],
+        )
+
+
+def solr_update(core, document, atomic=False, commit_within=SOLR_UPDATE_COMMIT_WITHIN):
+    """
+    Update a single document. In atomic mode every field of ``document`` is sent
+    as a ``set`` operation, so the stored document (and its content) is not
+    fetched and re-sent. Otherwise the stored document is merged and re-added.
+    The change becomes visible through commitWithin, pass ``commit_within=None``
+    for an immediate hard commit.
+    """
+    solr_updates = SolrUpdateBuffer(core, name="update " + str(document["id"]), commit_within=commit_within)
+    if atomic:
+        solr_updates.add({key: value if key == "id" else {"set": value} for key, value in document.items()})
     else:
-        client.add([document], commit=True)
+        client = get_solr_client(core)
+        document_existing_result = client.search("id:" + str(document["id"]))
+        if len(document_existing_result.docs) == 1:
+            document_existing = document_existing_result.docs[0]
+            for key, value in document.items():
+                if key == "file_url":
+                    document_existing[key] = value.name
+                elif key != "id":
+                    document_existing[key] = value
+            solr_updates.add(document_existing)
+        else:
+            solr_updates.add(document)
+
+    if commit_within:
+        solr_updates.flush()
+    else:
+        solr_updates.commit()
 
 
 def solr_add_file(core, file, file_id, file_url, document_id):
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
+    client = get_solr_client(core)
     extra_params = {
         "commit": "true",
         "literal.id": file_id,
@@ -357,48 +807,14 @@ def solr_add_file(core, file, file_id, file_url, document_id):
         "literal.document_id": document_id,
     }
     client.extract(file, extractOnly=False, **extra_params)
+    forget_index_version(core)
 
 
 def solr_delete(core, id):
     try:
-        client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
+        client = get_solr_client(core)
         client.delete(id=id)
         client.commit()
+        forget_index_version(core)
     except pysolr.SolrError:
         pass
-
-
-"""
-Use Solr MoreLikeThis https://lucene.apache.org/solr/guide/8_5/morelikethis.html
-to find similar documents given a document id. Solr MLT returns candidates, apply coefficient to candidates
-upon which a threshold can be applied: see https://www.dexstr.io/finding-duplicates-large-set-files/.
-"""
-
-
-def solr_mlt(core, id, mlt_field="title,content", number_candidates=5, threshold=0.0):
-    client = pysolr.Solr(os.environ["SOLR_URL"] + "/" + core)
-    search_result = client.search(
-        "id:" + id,
-        **{"mlt": "true", "mlt.fl": mlt_field, "mlt.count": number_candidates, "fl": "id,website," + mlt_field}
-    )
-    # document to compare against
-
-    similar_documents_with_coeff = []
-
-    if search_result:
-        base_doc = search_result.docs[0]
-
-        base_tokens = base_doc["content"][0].split()
-
-        # list of similar documents with Jaccard coefficient
-
-        for doc in search_result.raw_response["moreLikeThis"][id]["docs"]:
-            candidate_tokens = doc["content"][0].split()
-            similarity = textdistance.jaccard(base_tokens, candidate_tokens)
-            if similarity > float(threshold):
-                similar_documents_with_coeff.append((doc["id"], doc["title"][0], doc["website"][0], similarity))
-
-        # sort descending on coefficient
-        similar_documents_with_coeff.sort(key=lambda x: x[-1], reverse=True)
-
-    return similar_documents_with_coeff
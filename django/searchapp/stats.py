@@ -0,0 +1,31 @@
+"""
+Periodic logging of the per-process cache and connection pool counters.
+
+Every gunicorn and celery worker process keeps its own counters. They are logged with the pid, so the lines of
+the workers can be told apart and summed.
+"""
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 0 disables the stats log lines
+STATS_LOG_INTERVAL = int(os.environ.get("STATS_LOG_INTERVAL", 300))
+
+_logged_at = {}
+_logged_at_lock = threading.Lock()
+
+
+def log_stats_periodically(name, get_stats):
+    """Log get_stats() at most once per STATS_LOG_INTERVAL seconds, called on the path that updates the counters."""
+    if STATS_LOG_INTERVAL <= 0:
+        return
+    now = time.time()
+    with _logged_at_lock:
+        logged_at = _logged_at.setdefault(name, now)
+        if now - logged_at < STATS_LOG_INTERVAL:
+            return
+        _logged_at[name] = now
+    logger.info("%s stats of process %s: %s", name, os.getpid(), get_stats())
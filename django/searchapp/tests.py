@@ -1,3 +1,135 @@
-from django.test import TestCase
+from unittest import skipUnless
 
-# Create your tests here.
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+
+from searchapp.datahandling import SPAN_CLOSE_TAG, render_annotations
+from searchapp.minhash import (
+    MINHASH_BANDS,
+    MINHASH_NUM_PERM,
+    compute_signature,
+    get_band_keys,
+    get_shingles,
+    similar_documents,
+    update_document_signature,
+)
+from searchapp.models import Document, DocumentSignature, Website
+
+WORDS = [
+    "capital",
+    "liquidity",
+    "reporting",
+    "institution",
+    "requirement",
+    "exposure",
+    "supervisory",
+    "authority",
+    "resolution",
+    "market",
+    "risk",
+    "credit",
+]
+
+
+def make_text(offset, length=120):
+    return " ".join(WORDS[(i * 7 + offset + i // len(WORDS)) % len(WORDS)] + str(i % 13) for i in range(length))
+
+
+class MinHashTestCase(SimpleTestCase):
+    def test_shingles(self):
+        self.assertEqual(get_shingles("The  EBA, the ESMA", size=2), {"the eba", "eba the", "the esma"})
+        # texts shorter than a shingle are one shingle, texts without words have none
+        self.assertEqual(get_shingles("EBA report", size=5), {"eba report"})
+        self.assertEqual(get_shingles(" ,. ", size=5), set())
+        self.assertIsNone(compute_signature(" ,. "))
+
+    def test_signature(self):
+        signature = compute_signature(make_text(0))
+        self.assertEqual(len(signature), MINHASH_NUM_PERM)
+        # signatures are comparable between runs and workers
+        self.assertTrue((signature == compute_signature(make_text(0))).all())
+        self.assertTrue((signature == compute_signature(make_text(0).upper())).all())
+
+    def test_band_keys(self):
+        signature = compute_signature(make_text(0))
+        keys = get_band_keys(signature)
+        self.assertEqual(len(keys), MINHASH_BANDS)
+        self.assertEqual(keys, get_band_keys(signature.copy()))
+        self.assertTrue(all(-(2 ** 63) <= key < 2 ** 63 for key in keys))
+
+        # one changed value only changes the key of its band
+        rows = MINHASH_NUM_PERM // MINHASH_BANDS
+        changed = signature.copy()
+        changed[rows] += 1
+        changed_keys = get_band_keys(changed)
+        self.assertNotEqual(keys[1], changed_keys[1])
+        self.assertEqual(keys[:1] + keys[2:], changed_keys[:1] + changed_keys[2:])
+
+        # equal rows in another band give another key
+        repeated = signature.copy()
+        repeated[rows : 2 * rows] = repeated[:rows]
+        repeated_keys = get_band_keys(repeated)
+        self.assertNotEqual(repeated_keys[0], repeated_keys[1])
+
+
+@skipUnless(connection.vendor == "postgresql", "Band keys are stored in a postgres array")
+class SimilarDocumentsTestCase(TestCase):
+    def setUp(self):
+        website = Website.objects.create(name="EBA", url="https://eba.europa.eu")
+        other_website = Website.objects.create(name="ESMA", url="https://esma.europa.eu")
+        base_text = make_text(0)
+        near_text = base_text.replace("capital0", "leverage0", 1)
+        self.documents = {}
+        for name, site, text in [
+            ("base", website, base_text),
+            ("near", other_website, near_text),
+            ("same website", website, base_text),
+            ("other", other_website, make_text(5)),
+        ]:
+            document = Document.objects.create(title=name, url="https://" + name.replace(" ", "-"), website=site)
+            update_document_signature(document.id, text, content_hash="")
+            self.documents[name] = str(document.id)
+
+    def test_threshold(self):
+        results = similar_documents(self.documents["base"], threshold=0.5)
+        self.assertEqual([result[1] for result in results], ["same website", "near"])
+        self.assertEqual(results[0][3], 1.0)
+        self.assertTrue(0.5 < results[1][3] < 1.0)
+        self.assertEqual(results[1][2], "esma")
+
+        self.assertEqual(similar_documents(self.documents["base"], threshold=1.0), [])
+        self.assertEqual(len(similar_documents(self.documents["base"], threshold=0.5, limit=1)), 1)
+        results = similar_documents(self.documents["base"], threshold=0.5, cross_website_only=True)
+        self.assertEqual([result[1] for result in results], ["near"])
+
+    def test_unchanged_content(self):
+        base = self.documents["base"]
+        content_hash = DocumentSignature.objects.get(pk=base).content_hash
+        self.assertFalse(update_document_signature(base, make_text(0), source_hash="abc"))
+        signature = DocumentSignature.objects.get(pk=base)
+        self.assertEqual((signature.content_hash, signature.source_hash), (content_hash, "abc"))
+
+
+class RenderAnnotationsTestCase(SimpleTestCase):
+    text = "abcdefgh"
+
+    def render(self, *spans):
+        return render_annotations(self.text, spans).replace(SPAN_CLOSE_TAG, "</>")
+
+    def test_nested(self):
+        self.assertEqual(self.render((0, 8, "<a>"), (2, 4, "<b>")), "<a>ab<b>cd</>efgh</>")
+        # spans with the same start are opened outer first
+        self.assertEqual(self.render((0, 2, "<b>"), (0, 6, "<a>")), "<a><b>ab</>cdef</>gh")
+        self.assertEqual(self.render((2, 4, "<a>"), (2, 4, "<b>")), "ab<a><b>cd</></>efgh")
+
+    def test_overlapping(self):
+        # the inner span is closed with the span it overlaps and reopened after it
+        self.assertEqual(self.render((0, 4, "<a>"), (2, 6, "<b>")), "<a>ab<b>cd</></><b>ef</>gh")
+        self.assertEqual(
+            self.render((0, 4, "<a>"), (2, 6, "<b>"), (3, 8, "<c>")),
+            "<a>ab<b>c<c>d</></></><b><c>ef</></><c>gh</>",
+        )
+
+    def test_invalid_spans(self):
+        self.assertEqual(self.render(), self.text)
+        self.assertEqual(self.render((-1, 2, "<a>"), (3, 3, "<a>"), (5, 100, "<a>")), self.text)
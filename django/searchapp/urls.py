@@ -99,6 +99,11 @@ urlpatterns = [
     ),
     # solr_get_preanalyzed_for_doc
     path("api/solrdocuments/like/<id>", views.SimilarDocumentsAPIView.as_view(), name="similar_documents_api"),
+    path(
+        "api/solrdocuments/duplicates",
+        views.NearDuplicateDocumentsAPIView.as_view(),
+        name="near_duplicate_documents_api",
+    ),
     # Export
     path("api/export/launch", views.ExportDocumentsLaunch.as_view(), name="export_launch_api"),
     path("api/export/status/<task_id>", views.ExportDocumentsStatus.as_view(), name="export_status_api"),
@@ -2,10 +2,13 @@ import json
 import logging
 import os
 import re
+import uuid
 
 import requests
 from celery.result import AsyncResult
-from django.db.models import Q, Count
+from django.db.models import Q, Count, IntegerField, OuterRef, Subquery
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
 from django.db.models.functions import Length
 from django.http import FileResponse
 from lxml import html
@@ -16,12 +19,12 @@ from rest_framework.generics import RetrieveUpdateDestroyAPIView, ListCreateAPIV
 from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.response import Response
 from rest_framework.views import APIView
-import pysolr
 
 from glossary.models import Concept, ConceptOccurs, ConceptDefined
 from obligations.models import ReportingObligation, ReportingObligationOffsets
 from scheduler.tasks import export_documents, sync_documents_task, score_documents_task
 from scheduler.tasks_single import full_service_single
+from .minhash import MINHASH_THRESHOLD, near_duplicates, similar_documents
 from .models import Website, Document, Attachment, AcceptanceState, AcceptanceStateValue, Comment, Tag, Bookmark
 from .permissions import IsOwner, IsOwnerOrSuperUser
 from .serializers import (
@@ -36,13 +39,13 @@ from .serializers import (
 from .solr_call import (
     solr_search_id,
     solr_search_paginated,
-    solr_mlt,
     solr_search_query_paginated_preanalyzed,
     solr_search_ids,
-    solr_get_preanalyzed_for_doc,
+    solr_get_preanalyzed_for_docs,
     solr_search_query_with_doc_id_preanalyzed,
     solr_search_content_by_id,
     solr_search_website_paginated,
+    get_solr_client,
 )
 from django.contrib.auth.models import User, Group
 from glossary.models import AcceptanceState as ConceptAcceptanceState
@@ -92,6 +95,25 @@ class SmallResultsSetPagination(LimitOffsetPagination):
     offset_query_param = "offset"
 
 
+def solr_ids_array(core, solr_query):
+    """
+    Postgres uuid[] literal with the ids of the Solr documents matching the query, None without hits.
+
+    The ids are streamed from Solr into a single array parameter, which Postgres unnests and joins on the
+    primary key. This avoids an IN list with a placeholder per id for large hit sets.
+    """
+    ids = []
+    for doc in solr_search_ids(core, solr_query):
+        try:
+            ids.append(str(uuid.UUID(doc["id"])))
+        except ValueError:
+            # not a Django document
+            continue
+    if not ids:
+        return None
+    return "{" + ",".join(ids) + "}"
+
+
 class DocumentListAPIView(ListCreateAPIView):
     serializer_class = DocumentSerializer
     pagination_class = SmallResultsSetPagination
@@ -120,14 +142,10 @@ class DocumentListAPIView(ListCreateAPIView):
 
         if len(keyword) > 0:
             solr_query = f'id:"{keyword}" OR title:"{keyword}" OR content:"{keyword}" OR celex:"{keyword}"'
-            solr_result = solr_search_ids("documents", solr_query)
+            solr_ids = solr_ids_array("documents", solr_query)
 
-            id_list = []
-            for doc in solr_result:
-                id_list.append(doc["id"])
-
-            if len(id_list) > 0:
-                q = q.filter(id__in=id_list)
+            if solr_ids:
+                q = q.filter(id__in=RawSQL("SELECT unnest(%s::uuid[])", [solr_ids]))
             else:
                 if keyword:
                     q = q.filter(title__icontains=keyword)
@@ -226,6 +244,10 @@ class DocumentDetailAPIView(RetrieveUpdateDestroyAPIView):
                 document.content = solr_doc["content_html"][0]
         return document
 
+    def perform_update(self, serializer):
+        document = serializer.save()
+        document.update_solr_on_commit()
+
 
 class AttachmentListAPIView(ListCreateAPIView):
     queryset = Attachment.objects.all()
@@ -273,7 +295,7 @@ class AcceptanceStateListAPIView(ListCreateAPIView):
         AcceptanceState.objects.update_or_create(document=document, user=request.user, defaults={"value": data_value})
 
         # TODO Update Acceptance State in SOLR
-        solr_client = pysolr.Solr(os.environ["SOLR_URL"] + "/documents")
+        solr_client = get_solr_client("documents")
 
         if data_value == "Rejected":
             if decision:
@@ -421,6 +443,7 @@ class SolrDocumentsSearchQueryPreAnalyzed(APIView):
             rows_per_page=request.GET.get("pageSize", 1),
             sort_by=request.GET.get("sortBy"),
             sort_direction=request.GET.get("sortDirection"),
+            full_content=request.GET.get("fullContent") == "true",
         )
         return Response(result)
 
@@ -437,10 +460,60 @@ class SolrDocumentSearchQueryPreAnalyzed(APIView):
             rows_per_page=request.GET.get("pageSize", 1),
             sort_by=request.GET.get("sortBy"),
             sort_direction=request.GET.get("sortDirection"),
+            full_content=request.GET.get("fullContent") == "true",
         )
         return Response(result)
 
 
+DOCUMENT_SORT_FIELDS = {"date": "date", "title": "title", "website": "website__name"}
+
+
+def count_per_document(queryset):
+    """Subquery counting the rows of the queryset per document, for annotating a Document queryset."""
+    counts = queryset.filter(document=OuterRef("pk")).order_by().values("document").annotate(count=Count("pk"))
+    return Coalesce(Subquery(counts.values("count"), output_field=IntegerField()), 0)
+
+
+def get_highlighted_documents_page(request, documents, field, term, fallback, extra_fields=()):
+    """
+    One page of documents with the first highlighted fragment of a pre-analyzed field, as [total, page].
+    The page is sorted and cut out in the database, the highlights of the whole page come from one Solr request.
+    Without a pageSize all documents are returned.
+    """
+    sort_by = DOCUMENT_SORT_FIELDS.get(request.GET.get("sortBy"), "date")
+    if request.GET.get("sortDirection") == "desc":
+        sort_by = "-" + sort_by
+    documents = documents.select_related("website").order_by(sort_by, "id")
+
+    total = documents.count()
+    page_size = int(request.GET.get("pageSize", 0)) or total
+    start = (int(request.GET.get("pageNumber", 1)) - 1) * page_size
+    page = list(documents[start : start + page_size])
+
+    highlights = solr_get_preanalyzed_for_docs(core="documents", ids=[doc.id for doc in page], field=field, term=term)
+
+    results = []
+    for document in page:
+        highlighting = highlights.get(str(document.id))
+        # Fallback if Solr fails
+        if not highlighting:
+            logger.info("solr couldn't find any highlighting for document %s", document.id)
+            highlighting = "<span class='highlight'>" + fallback + "</span>"
+
+        result = {
+            "title": document.title,
+            "date": document.date.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "id": str(document.id),
+            "website": str(document.website),
+            field: highlighting,
+        }
+        for extra_field in extra_fields:
+            result[extra_field] = getattr(document, extra_field)
+        results.append(result)
+
+    return [total, results]
+
+
 class SolrDocumentsSearchQueryDjango(APIView):
     queryset = Document.objects.none()
     pagination_class = SmallResultsSetPagination
@@ -451,48 +524,24 @@ class SolrDocumentsSearchQueryDjango(APIView):
 
         concept_defined_or_occurs = None
         if request.data["field"] == "concept_defined":
-            concept_defined_or_occurs = ConceptDefined.objects.filter(concept=concept).distinct("document")
+            concept_defined_or_occurs = ConceptDefined.objects.filter(concept=concept)
         else:
-            concept_defined_or_occurs = ConceptOccurs.objects.filter(concept__name=concept.name).distinct("document")
-
-
-        definitions = []
-        for defi_or_occ in concept_defined_or_occurs:
-            total_occurances_def = len(ConceptDefined.objects.filter(concept=concept, document=defi_or_occ.document))
-            total_occurances_occ = len(ConceptOccurs.objects.filter(concept__name=concept.name, document=defi_or_occ.document))
-
-            highlighting = solr_get_preanalyzed_for_doc(
-                core="documents",
-                id=defi_or_occ.document.id,
-                field=request.data["field"],
-                term=request.data["term"],
-                page_number=request.GET.get("pageNumber", 1),
-                rows_per_page=request.GET.get("pageSize", 1),
-                sort_by=request.GET.get("sortBy"),
-                sort_direction=request.GET.get("sortDirection"),
-            )
-
-            # Fallback if Solr fails
-            if not highlighting:
-                logger.info("solr couldn't find any highlighting")
-                highlighting = "<span class='highlight'>" + defi_or_occ.concept.name + "</span>"
-
-            date = defi_or_occ.document.date.strftime("%Y-%m-%dT%H:%M:%SZ")
+            concept_defined_or_occurs = ConceptOccurs.objects.filter(concept__name=concept.name)
 
+        # the occurrence counts are computed in the same query as the page
+        documents = Document.objects.filter(pk__in=concept_defined_or_occurs.values("document_id")).annotate(
+            occurances_def=count_per_document(ConceptDefined.objects.filter(concept=concept)),
+            occurances_occ=count_per_document(ConceptOccurs.objects.filter(concept__name=concept.name)),
+        )
 
-            definitions.append(
-                {
-                    "title": defi_or_occ.document.title,
-                    "date": date,
-                    "id": str(defi_or_occ.document.id),
-                    "website": str(defi_or_occ.document.website),
-                    request.data["field"]: highlighting,
-                    "occurances_occ": total_occurances_occ,
-                    "occurances_def": total_occurances_def,
-                }
-            )
-
-        response = [len(definitions), definitions]
+        response = get_highlighted_documents_page(
+            request,
+            documents,
+            field=request.data["field"],
+            term=request.data["term"],
+            fallback=concept.name,
+            extra_fields=["occurances_occ", "occurances_def"],
+        )
 
         return Response(response)
 
@@ -504,39 +553,15 @@ class SolrDocumentsSearchQueryDjangoReportingObligation(APIView):
 
         ro = ReportingObligation.objects.get(pk=request.data["id"])
 
-        ro_occurs = None
+        documents = Document.objects.none()
         if request.data["field"] == "ro_highlight":
-            ro_occurs = ReportingObligationOffsets.objects.filter(ro=ro).distinct("document")
-
-        occurrences = []
-        for occ in ro_occurs:
-            highlighting = solr_get_preanalyzed_for_doc(
-                core="documents",
-                id=occ.document.id,
-                field=request.data["field"],
-                term=request.data["ro"],
-                page_number=request.GET.get("pageNumber", 1),
-                rows_per_page=request.GET.get("pageSize", 1),
-                sort_by=request.GET.get("sortBy"),
-                sort_direction=request.GET.get("sortDirection"),
+            documents = Document.objects.filter(
+                pk__in=ReportingObligationOffsets.objects.filter(ro=ro).values("document_id")
             )
 
-            # Fallback if Solr fails
-            if not highlighting:
-                highlighting = "<span class='highlight'>" + ro.name + "</span>"
-
-            date = occ.document.date.strftime("%Y-%m-%dT%H:%M:%SZ")
-            occurrences.append(
-                {
-                    "title": occ.document.title,
-                    "date": date,
-                    "id": str(occ.document.id),
-                    "website": str(occ.document.website),
-                    request.data["field"]: highlighting,
-                }
-            )
-
-        response = [len(occurrences), occurrences]
+        response = get_highlighted_documents_page(
+            request, documents, field=request.data["field"], term=request.data["ro"], fallback=ro.name
+        )
 
         return Response(response)
 
@@ -545,11 +570,11 @@ class SimilarDocumentsAPIView(APIView):
     queryset = Document.objects.none()
 
     def get(self, request, id):
-        similar_document_ids_with_coeff = solr_mlt(
-            "documents",
+        similar_document_ids_with_coeff = similar_documents(
             str(id),
-            number_candidates=request.GET.get("numberCandidates", 5),
             threshold=request.GET.get("threshold", 0.0),
+            limit=request.GET.get("numberCandidates", 5),
+            cross_website_only=request.GET.get("crossWebsite") == "true",
         )
         formatted_response = []
         for id, title, website, coeff in similar_document_ids_with_coeff:
@@ -557,6 +582,29 @@ class SimilarDocumentsAPIView(APIView):
         return Response(formatted_response)
 
 
+class NearDuplicateDocumentsAPIView(APIView):
+    """Pairs of near-duplicate documents, by default only the pairs published on different websites."""
+
+    queryset = Document.objects.none()
+
+    def get(self, request):
+        pairs = near_duplicates(
+            threshold=float(request.GET.get("threshold", MINHASH_THRESHOLD)),
+            cross_website_only=request.GET.get("crossWebsite", "true") == "true",
+        )[: int(request.GET.get("numberPairs", 100))]
+        document_ids = set(document_id for first, second, _ in pairs for document_id in (first, second))
+        documents = {
+            str(document_id): {"id": str(document_id), "title": title, "website": website.lower()}
+            for document_id, title, website in Document.objects.filter(pk__in=document_ids).values_list(
+                "id", "title", "website__name"
+            )
+        }
+        formatted_response = []
+        for first, second, coeff in pairs:
+            formatted_response.append({"first": documents[first], "second": documents[second], "coefficient": coeff})
+        return Response(formatted_response)
+
+
 class FormexUrlsAPIView(APIView):
     queryset = Document.objects.none()
 
@@ -619,7 +667,11 @@ class ExportDocumentsStatus(APIView):
 
     def get(self, request, task_id, format=None):
         result = AsyncResult(task_id)
-        return Response(result.status, status=status.HTTP_200_OK)
+        response = {"status": result.status, "percent": 100 if result.successful() else 0}
+        # export_documents reports the number of exported documents with a PROGRESS state
+        if isinstance(result.info, dict) and "percent" in result.info:
+            response.update(result.info)
+        return Response(response, status=status.HTTP_200_OK)
 
 
 class ExportDocumentsDownload(APIView):